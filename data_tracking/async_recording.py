@@ -0,0 +1,93 @@
+"""Asynchronous variant of files_recording.visit (requires Python 3.5 or later)."""
+
+import asyncio
+import functools
+import logging
+from concurrent import futures
+
+from . import files_recording
+
+
+##########################################################################
+# SETTINGS
+##########################################################################
+
+QUEUE_SIZE = 64  # Number of files being inspected or waiting to be recorded (the walk is paused when it is full)
+
+
+##########################################################################
+# PUBLIC FUNCTIONS
+##########################################################################
+
+async def avisit(folder, provenance_id, step_name, previous_step_id=None, config=None, db_url=None, is_organised=True,
+                 executor=None, queue_size=QUEUE_SIZE, batch_size=files_recording.DATA_FILE_BATCH_SIZE,
+                 fingerprint_index=None, include=None, exclude=None, max_depth=None, shard=None, shard_by='folder',
+                 checkpoint=None, resume=False, checkpoint_interval=files_recording.CHECKPOINT_INTERVAL,
+                 nifti_layout=None, recycle_interval=files_recording.SESSION_RECYCLE_INTERVAL, low_memory=False):
+    """Record all files from a folder into the database, without blocking the event loop.
+
+    Note:
+    The folders are walked, the files are inspected (type detection, partial hash and DICOM header) and the database is
+    written concurrently. The database driver is blocking, so all the database work runs in a single dedicated thread,
+    in the order the files are found. The files being inspected or waiting to be recorded are held in a bounded queue:
+    when the database is the bottleneck, the walk and the inspections are paused.
+
+    Arguments:
+    :param executor: (optional) A concurrent.futures executor used to inspect the files (e.g. a ProcessPoolExecutor).
+    By default, the default executor of the event loop is used. It is not shut down by this function.
+    :param queue_size: (optional) Maximum number of files being inspected or waiting to be recorded.
+    See files_recording.visit for the other parameters.
+    :return: return processing step ID.
+    """
+    loop = asyncio.get_event_loop()
+    # SQLAlchemy sessions and the files listing generator must not be used by several threads at once
+    db_executor = futures.ThreadPoolExecutor(max_workers=1)
+    walk_executor = futures.ThreadPoolExecutor(max_workers=1)
+    queue = asyncio.Queue(maxsize=max(queue_size, 1))
+
+    logging.info("Visiting %s asynchronously", folder)
+
+    async def produce():
+        try:
+            files = recorder.list_files(folder, include, exclude, max_depth, shard, shard_by)
+            while True:
+                args = await loop.run_in_executor(walk_executor, next, files, None)
+                if args is None:
+                    break
+                await queue.put(loop.run_in_executor(executor, files_recording.inspect_file, *args))
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            # Stop the consumer, which then gets this error when awaiting the producer
+            await queue.put(None)
+            raise
+        await queue.put(None)
+
+    try:
+        recorder = await loop.run_in_executor(db_executor, functools.partial(
+            files_recording.FileRecorder, provenance_id, step_name, previous_step_id, config, db_url, is_organised,
+            batch_size, fingerprint_index, checkpoint, resume, checkpoint_interval, nifti_layout, recycle_interval,
+            low_memory))
+
+        producer = asyncio.ensure_future(produce())
+        try:
+            while True:
+                inspection = await queue.get()
+                if inspection is None:
+                    break
+                inspected = await inspection
+                await loop.run_in_executor(db_executor, recorder.record, inspected)
+            await producer
+        except BaseException:
+            # Roll back in the thread which owns the database connection
+            await loop.run_in_executor(db_executor, recorder.db_conn.db_session.close)
+            raise
+        finally:
+            producer.cancel()
+
+        await loop.run_in_executor(db_executor, recorder.close)
+    finally:
+        walk_executor.shutdown(wait=False)
+        db_executor.shutdown(wait=False)
+
+    return recorder.step_id
@@ -0,0 +1,36 @@
+import collections
+
+
+#######################################################################################################################
+# CLASSES
+#######################################################################################################################
+
+class LRUCache:
+    """A dictionary-like cache keeping at most max_size entries. The least recently used entries are evicted first."""
+
+    def __init__(self, max_size=10000):
+        self.max_size = max_size
+        self._entries = collections.OrderedDict()
+
+    def get(self, key, default=None):
+        try:
+            value = self._entries.pop(key)
+        except KeyError:
+            return default
+        self._entries[key] = value
+        return value
+
+    def put(self, key, value):
+        self._entries.pop(key, None)
+        self._entries[key] = value
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+
+    def clear(self):
+        self._entries.clear()
+
+    def __contains__(self, key):
+        return key in self._entries
+
+    def __len__(self):
+        return len(self._entries)
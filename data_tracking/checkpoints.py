@@ -0,0 +1,63 @@
+import json
+import logging
+import os
+
+
+#######################################################################################################################
+# CLASSES
+#######################################################################################################################
+
+class Checkpoint:
+    """Local file storing how far the visit of a processing step went.
+
+    A checkpoint is the last folder whose files are all committed in the catalog, in the walk order (see walker.walk).
+    """
+
+    def __init__(self, checkpoint_path, step_id):
+        """
+        Arguments:
+        :param checkpoint_path: Path of the checkpoint file.
+        :param step_id: Processing step ID.
+        """
+        self.checkpoint_path = checkpoint_path
+        self.step_id = step_id
+
+    def load(self):
+        """Read the checkpoint.
+
+        :return: Path of the last completed folder (relative to the visited folder) or None if there is no checkpoint
+        for this processing step.
+        """
+        try:
+            with open(self.checkpoint_path) as f:
+                checkpoint = json.load(f)
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError):
+            logging.warning("Cannot read the checkpoint %s" % self.checkpoint_path)
+            return None
+        if checkpoint.get('step_id') != self.step_id:
+            logging.warning("Checkpoint %s belongs to another processing step" % self.checkpoint_path)
+            return None
+        return checkpoint.get('folder')
+
+    def save(self, folder, count):
+        """Replace the checkpoint. The file is replaced atomically, so a crash cannot leave it half written.
+
+        Arguments:
+        :param folder: Path of the last completed folder, relative to the visited folder.
+        :param count: Number of files recorded so far (for information).
+        """
+        tmp_path = self.checkpoint_path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump({'step_id': self.step_id, 'folder': folder, 'files': count}, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.checkpoint_path)
+
+    def clear(self):
+        """Remove the checkpoint, once the visit is complete."""
+        try:
+            os.remove(self.checkpoint_path)
+        except FileNotFoundError:
+            pass
@@ -1,20 +1,61 @@
+import decimal
+import hashlib
+import logging
+import numbers
+import os
+import pickle
+import threading
+
 from sqlalchemy import create_engine
+from sqlalchemy import event
+from sqlalchemy import exc
+from sqlalchemy.dialects import postgresql
 from sqlalchemy.ext.automap import automap_base
 from sqlalchemy import orm
+from sqlalchemy import schema
+from sqlalchemy import sql
 from sqlalchemy.sql import functions as sql_func
 
 from airflow import configuration
 
+from . import cache
+from . import data_file_writer
+from . import records
+
+
+ID_CACHE_SIZE = 10000  # Maximum number of participant/visit/session/sequence/repetition IDs kept in memory
+METADATA_CACHE_FILE = None  # When set, the reflected schema is pickled to this file and loaded from it at start-up
+SEQUENCE_TYPE_COLUMNS = list(records.SequenceTypeKey._fields)  # Columns identifying a sequence type
+SEQUENCE_TYPE_FINGERPRINT_COLUMN = 'fingerprint'  # Optional (indexed) column of the sequence_type table
+FLOAT_PRECISION = 6  # Number of significant digits kept when comparing floating point values
+
+_schemas = dict()
+_schemas_lock = threading.Lock()
+_sequences = dict()
+_sequences_lock = threading.Lock()
+
+
+def dispose(db_url=None):
+    """Forget the schema reflected for a database and close its pooled connections.
+
+    Arguments:
+    :param db_url: (optional) Database URL. If not defined, all the databases are disposed.
+    """
+    with _schemas_lock:
+        for url in [db_url] if db_url else list(_schemas):
+            engine, _ = _schemas.pop(url, (None, None))
+            if engine:
+                engine.dispose()
+
 
 class Connection:
 
-    def __init__(self, db_url=None):
+    def __init__(self, db_url=None, batch_size=1, cache_size=ID_CACHE_SIZE, metadata_cache=None):
         if db_url is None:
             db_url = configuration.get('data-factory', 'DATA_CATALOG_SQL_ALCHEMY_CONN')
 
-        self.Base = automap_base()
-        self.engine = create_engine(db_url)
-        self.Base.prepare(self.engine, reflect=True)
+        # Engines (and their pools) and mapped classes are shared by all the connections to a same database
+        self.engine, self.Base = _get_schema(db_url, metadata_cache or METADATA_CACHE_FILE)
 
         self.ParticipantMapping = self.Base.classes.participant_mapping
         self.Participant = self.Base.classes.participant
@@ -28,81 +69,349 @@ class Connection:
         self.ProcessingStep = self.Base.classes.processing_step
         self.Provenance = self.Base.classes.provenance
 
-        self.db_session = orm.Session(self.engine)
+        # IDs resolved from natural keys. They might not exist anymore after a rollback.
+        self.id_cache = cache.LRUCache(cache_size)
+        self.sequence_type_ids = None
+        # Rows upserted during the current transaction
+        self.upserted = cache.LRUCache(cache_size)
+
+        self.db_session = self._new_session()
+        self.data_files = data_file_writer.DataFileWriter(self, batch_size)
+
+    def commit(self):
+        """Write the buffered data files and commit the current transaction.
+
+        The hierarchy resolution methods only execute their statements (to get the generated IDs), so nothing is
+        committed before this is called. The mapped objects loaded so far are then detached from the session, so that
+        it does not grow from one batch to another.
+        """
+        self.data_files.flush()
+        self.db_session.commit()
+        self.db_session.expunge_all()
+        self.upserted.clear()
 
     def close(self):
+        self.commit()
+        self.db_session.close()
+
+    def recycle(self):
+        """Commit the changes and replace the session by a new one, releasing everything the previous one held."""
+        self.commit()
         self.db_session.close()
+        self.db_session = self._new_session()
+
+    def has_unique_key(self, table, *columns):
+        """Check that a set of columns is covered by a primary key, a unique constraint or a unique index."""
+        columns = set(columns)
+        for constraint in table.constraints:
+            if isinstance(constraint, (schema.PrimaryKeyConstraint, schema.UniqueConstraint)) \
+                    and set(c.name for c in constraint.columns) == columns:
+                return True
+        for index in table.indexes:
+            if index.unique and set(c.name for c in index.columns) == columns:
+                return True
+        return False
+
+    def get_or_create_id(self, model, keys, values=None, id_column='id'):
+        """Get the ID of the row identified by some key columns, and insert this row if it does not exist yet.
+
+        On PostgreSQL, when the key columns are unique, this is a single INSERT ... ON CONFLICT DO NOTHING RETURNING
+        statement (it is thus safe when several processes create the same row). On SQLite, it is an INSERT OR IGNORE
+        followed by a SELECT. Otherwise, the row is looked up before being inserted. Resolved IDs are cached.
+
+        Arguments:
+        :param model: Mapped class.
+        :param keys: Dictionary of the key column values.
+        :param values: (optional) Dictionary of the other column values of a new row. It can also be a function
+        returning this dictionary, when computing it is costly (e.g. allocating an ID): the row is then looked up
+        first.
+        :param id_column: (optional) Name of the returned column. Default is 'id'.
+        :return: ID of the row.
+        """
+        table = model.__table__
+        key = _cache_key(table, keys)
+        row_id = self.id_cache.get(key)
+        if row_id is not None:
+            return row_id
+
+        select = sql.select([table.c[id_column]]).where(_criteria(table, keys))
+        looked_up = callable(values)
+        if looked_up:
+            row_id = self.db_session.execute(select).scalar()
+            values = values() if row_id is None else None
+        if row_id is None:
+            row = dict(keys, **(values or {}))
+            # NULL keys never conflict
+            unique = None not in keys.values() and self.has_unique_key(table, *keys)
+            dialect = self.engine.dialect.name
+            if unique and 'postgresql' == dialect:
+                inserted = postgresql.insert(table).values(row).on_conflict_do_nothing(
+                    index_elements=list(keys)).returning(table.c[id_column]).cte('inserted')
+                row_id = self.db_session.execute(
+                    sql.select([inserted.c[id_column]]).union_all(select).limit(1)).scalar()
+                if row_id is None:
+                    # Inserted by a concurrent transaction committed after this statement started
+                    row_id = self.db_session.execute(select).scalar()
+            elif unique and 'sqlite' == dialect:
+                self.db_session.execute(table.insert().prefix_with('OR IGNORE').values(row))
+                row_id = self.db_session.execute(select).scalar()
+            else:
+                if not looked_up:
+                    row_id = self.db_session.execute(select).scalar()
+                if row_id is None:
+                    result = self.db_session.execute(table.insert().values(row))
+                    row_id = row[id_column] if id_column in row else result.inserted_primary_key[0]
+        self.id_cache.put(key, row_id)
+        return row_id
+
+    def upsert(self, model, keys, values):
+        """Insert a row or, if a row with the same key columns exists, update it. The row must have an 'id' column.
+
+        On PostgreSQL, when the key columns are unique, this is a single INSERT ... ON CONFLICT DO UPDATE RETURNING
+        statement. Otherwise, the row is looked up before being inserted or updated. Upserting the same values again is
+        skipped until the transaction ends.
+
+        Arguments:
+        :param model: Mapped class.
+        :param keys: Dictionary of the key column values.
+        :param values: Dictionary of the other column values.
+        :return: ID of the row.
+        """
+        table = model.__table__
+        key = _cache_key(table, keys) + tuple(sorted(values.items(), key=lambda item: item[0]))
+        row_id = self.upserted.get(key)
+        if row_id is not None:
+            return row_id
+
+        if None not in keys.values() and 'postgresql' == self.engine.dialect.name \
+                and self.has_unique_key(table, *keys):
+            stmt = postgresql.insert(table).values(dict(keys, **values))
+            if values:
+                stmt = stmt.on_conflict_do_update(
+                    index_elements=list(keys), set_={col: stmt.excluded[col] for col in values})
+            else:
+                stmt = stmt.on_conflict_do_nothing(index_elements=list(keys))
+            row_id = self.db_session.execute(stmt.returning(table.c.id)).scalar()
+            if row_id is None:
+                row_id = self.db_session.execute(
+                    sql.select([table.c.id]).where(_criteria(table, keys)).limit(1)).scalar()
+        else:
+            row_id = self.db_session.execute(
+                sql.select([table.c.id]).where(_criteria(table, keys)).limit(1)).scalar()
+            if row_id is None:
+                row = dict(keys, **values)
+                result = self.db_session.execute(table.insert().values(row))
+                row_id = row['id'] if 'id' in row else result.inserted_primary_key[0]
+            elif values:
+                self.db_session.execute(table.update().where(table.c.id == row_id).values(values))
+        self.upserted.put(key, row_id)
+        return row_id
+
+    def _new_session(self):
+        # The mapped objects are detached after each commit (see commit): expiring them first would only cost reloads
+        db_session = orm.Session(self.engine, expire_on_commit=False)
+        event.listen(db_session, 'after_soft_rollback', self._clear_id_cache)
+        return db_session
+
+    def _clear_id_cache(self, *_):
+        self.id_cache.clear()
+        self.upserted.clear()
+        self.sequence_type_ids = None
 
     def get_dataset(self, step_id):
-        provenance_id = self.db_session.query(self.ProcessingStep).filter_by(id=step_id).first().provenance_id
-        return self.db_session.query(self.Provenance).filter_by(id=provenance_id).first().dataset
+        key = ('dataset', step_id)
+        dataset = self.id_cache.get(key)
+        if dataset is None:
+            dataset = self.db_session.query(self.Provenance.dataset).join(
+                self.ProcessingStep, self.ProcessingStep.provenance_id == self.Provenance.id).filter(
+                self.ProcessingStep.id == step_id).scalar()
+            self.id_cache.put(key, dataset)
+        return dataset
 
     def new_participant_id(self):
-        try:
-            return self.db_session.query(
-                sql_func.max(self.ParticipantMapping.participant_id).label('max')).one().max + 1
-        except TypeError:
-            return 0
+        return self._new_id(self.ParticipantMapping.__table__.c.participant_id)
 
     def get_participant_id(self, participant_name, dataset):
-        participant_name = str(participant_name)
-        participant = self.db_session.query(self.ParticipantMapping).filter_by(
-            dataset=dataset, name=participant_name).one_or_none()
-        if not participant:
-            participant = self.ParticipantMapping(dataset=dataset, name=participant_name,
-                                                  participant_id=self.new_participant_id())
-            self.db_session.merge(participant)
-            self.db_session.commit()
-        return self.db_session.query(self.ParticipantMapping).filter_by(
-            dataset=dataset, name=participant_name).one_or_none().participant_id
+        return self._get_mapped_id(self.ParticipantMapping, {'dataset': dataset, 'name': str(participant_name)},
+                                   'participant_id')
 
     def new_visit_id(self):
+        return self._new_id(self.VisitMapping.__table__.c.visit_id)
+
+    def get_visit_id(self, visit_name, dataset):
+        return self._get_mapped_id(self.VisitMapping, {'dataset': dataset, 'name': str(visit_name)}, 'visit_id')
+
+    def _get_mapped_id(self, model, keys, id_column):
+        column = model.__table__.c[id_column]
+        if 'postgresql' != self.engine.dialect.name or _get_id_sequence(self.engine, column) is not None:
+            return self.get_or_create_id(model, keys, lambda: {id_column: self._new_id(column)}, id_column=id_column)
+        # Without a sequence, the mapping is created in its own transaction (see _allocate_id)
+        key = _cache_key(model.__table__, keys)
+        row_id = self.id_cache.get(key)
+        if row_id is None:
+            row_id = _allocate_id(self.engine, model.__table__, keys, column)
+            self.id_cache.put(key, row_id)
+        return row_id
+
+    def _new_id(self, column):
+        # On PostgreSQL, IDs come from a sequence (when the catalog has it) so that concurrent visits never allocate
+        # the same ID
+        sequence = _get_id_sequence(self.engine, column)
+        if sequence is not None:
+            return self.db_session.execute(sql.select([sequence.next_value()])).scalar()
         try:
-            return self.db_session.query(
-                sql_func.max(self.VisitMapping.visit_id).label('max')).one().max + 1
+            return self.db_session.query(sql_func.max(column).label('max')).one().max + 1
         except TypeError:
             return 0
 
-    def get_visit_id(self, visit_name, dataset):
-        visit_name = str(visit_name)
-        visit = self.db_session.query(self.VisitMapping).filter_by(
-            dataset=dataset, name=visit_name).one_or_none()
-        if not visit:
-            visit = self.VisitMapping(dataset=dataset, name=visit_name, visit_id=self.new_visit_id())
-            self.db_session.merge(visit)
-            self.db_session.commit()
-        return self.db_session.query(self.VisitMapping).filter_by(
-            dataset=dataset, name=visit_name).one_or_none().visit_id
-
     def get_session_id(self, session_name, visit_id):
-        session_name = str(session_name)
-        session = self.db_session.query(self.Session).filter_by(
-            name=session_name, visit_id=visit_id).one_or_none()
-        if not session:
-            session = self.Session(name=session_name, visit_id=visit_id)
-            self.db_session.merge(session)
-            self.db_session.commit()
-        return self.db_session.query(self.Session).filter_by(
-            name=session_name, visit_id=visit_id).one_or_none().id
+        return self.get_or_create_id(self.Session, {'name': str(session_name), 'visit_id': visit_id})
 
     def get_sequence_id(self, sequence_name, session_id):
-        sequence_name = str(sequence_name)
-        sequence = self.db_session.query(self.Sequence).filter_by(
-            name=sequence_name, session_id=session_id).one_or_none()
-        if not sequence:
-            sequence = self.Sequence(name=sequence_name, session_id=session_id)
-            self.db_session.merge(sequence)
-            self.db_session.commit()
-        return self.db_session.query(self.Sequence).filter_by(
-            name=sequence_name, session_id=session_id).one_or_none().id
+        return self.get_or_create_id(self.Sequence, {'name': str(sequence_name), 'session_id': session_id})
+
+    def get_sequence_type_id(self, fields):
+        """Get (or create) the ID of a sequence type.
+
+        Known sequence types are indexed in memory by their fingerprint (see sequence_type_fingerprint) the first time
+        this is called, so resolving an already known sequence type does not need any query.
+
+        Arguments:
+        :param fields: Dictionary of sequence_type column values (see SEQUENCE_TYPE_COLUMNS).
+        :return: Sequence type ID.
+        """
+        if self.sequence_type_ids is None:
+            self.sequence_type_ids = dict()
+            columns = [getattr(self.SequenceType, column) for column in SEQUENCE_TYPE_COLUMNS]
+            for row in self.db_session.query(self.SequenceType.id, *columns):
+                fingerprint = sequence_type_fingerprint(dict(zip(SEQUENCE_TYPE_COLUMNS, row[1:])))
+                self.sequence_type_ids.setdefault(fingerprint, row[0])
+
+        fingerprint = sequence_type_fingerprint(fields)
+        sequence_type_id = self.sequence_type_ids.get(fingerprint)
+        if sequence_type_id is not None:
+            return sequence_type_id
+
+        values = {column: fields.get(column) for column in SEQUENCE_TYPE_COLUMNS}
+        if SEQUENCE_TYPE_FINGERPRINT_COLUMN in self.SequenceType.__table__.c:
+            values[SEQUENCE_TYPE_FINGERPRINT_COLUMN] = _digest(fingerprint)
+            criteria = {SEQUENCE_TYPE_FINGERPRINT_COLUMN: values[SEQUENCE_TYPE_FINGERPRINT_COLUMN]}
+        else:
+            criteria = values
+        # It might have been created by another process since the index was loaded
+        sequence_type_id = self.get_or_create_id(
+            self.SequenceType, criteria, {k: v for k, v in values.items() if k not in criteria})
+        self.sequence_type_ids[fingerprint] = sequence_type_id
+        return sequence_type_id
 
     def get_repetition_id(self, repetition_name, sequence_id):
-        repetition_name = str(repetition_name)
-        repetition = self.db_session.query(self.Repetition).filter_by(
-            name=repetition_name, sequence_id=sequence_id).one_or_none()
-        if not repetition:
-            repetition = self.Repetition(name=repetition_name, sequence_id=sequence_id)
-            self.db_session.merge(repetition)
-            self.db_session.commit()
-        return self.db_session.query(self.Repetition).filter_by(
-            name=repetition_name, sequence_id=sequence_id).one_or_none().id
+        return self.get_or_create_id(self.Repetition, {'name': str(repetition_name), 'sequence_id': sequence_id})
+
+
+def _get_schema(db_url, metadata_cache=None):
+    with _schemas_lock:
+        if db_url not in _schemas:
+            engine = create_engine(db_url)
+            _schemas[db_url] = engine, _reflect(engine, metadata_cache)
+        return _schemas[db_url]
+
+
+def _reflect(engine, metadata_cache=None):
+    version = _get_schema_version(engine)
+    if metadata_cache and version is None:
+        # Without a version, there is no way to tell if the cached schema is outdated
+        logging.info("Catalog schema has no version, it is not cached in %s" % metadata_cache)
+        metadata_cache = None
+    if metadata_cache and os.path.isfile(metadata_cache):
+        try:
+            with open(metadata_cache, 'rb') as f:
+                cached_version, metadata = pickle.load(f)
+            if cached_version == version:
+                base = automap_base(metadata=metadata)
+                base.prepare()
+                return base
+            logging.info("Schema cached in %s is outdated" % metadata_cache)
+        except (OSError, EOFError, ValueError, pickle.UnpicklingError):
+            logging.warning("Cannot load the schema cached in %s" % metadata_cache)
+
+    base = automap_base()
+    base.prepare(engine, reflect=True)
+    if metadata_cache:
+        try:
+            with open(metadata_cache, 'wb') as f:
+                pickle.dump((version, base.metadata), f)
+        except OSError:
+            logging.warning("Cannot cache the schema in %s" % metadata_cache)
+    return base
+
+
+def _get_schema_version(engine):
+    # The catalog schema is managed by Alembic
+    try:
+        return engine.execute("SELECT version_num FROM alembic_version").scalar()
+    except exc.DBAPIError:
+        return None
+
+
+def _get_id_sequence(engine, column):
+    if 'postgresql' != engine.dialect.name:
+        return None
+    name = '%s_%s_seq' % (column.table.name, column.name)
+    with _sequences_lock:
+        if (engine.url, name) not in _sequences:
+            _sequences[engine.url, name] = _find_id_sequence(engine, name)
+        return _sequences[engine.url, name]
+
+
+def _find_id_sequence(engine, name):
+    # Like the rest of the catalog schema, the sequences are created by its migrations (see data-catalog-setup)
+    with engine.connect() as conn:
+        if engine.dialect.has_sequence(conn, name):
+            return schema.Sequence(name)
+    logging.warning("Sequence %s is missing from the catalog, please upgrade its schema. IDs are allocated under a "
+                    "lock instead, which serialises the visits creating participants or visits." % name)
+    return None
+
+
+def _allocate_id(engine, table, keys, column):
+    # max() + 1 is only safe if no other transaction holds an ID it did not commit yet: the new mapping is committed
+    # right away, under an advisory lock released by this commit. A mapping kept while the visit rolls back its own
+    # changes is harmless, it is reused by the next visit.
+    with engine.begin() as conn:
+        conn.execute(sql.select([sql.func.pg_advisory_xact_lock(sql.func.hashtext(table.name))]))
+        row_id = conn.execute(sql.select([column]).where(_criteria(table, keys)).limit(1)).scalar()
+        if row_id is None:
+            row_id = conn.execute(sql.select([sql_func.coalesce(sql_func.max(column) + 1, 0)])).scalar()
+            conn.execute(table.insert().values(dict(keys, **{column.name: row_id})))
+    return row_id
+
+
+def sequence_type_fingerprint(fields):
+    """Compute a canonical fingerprint of a sequence type.
+
+    Arguments:
+    :param fields: Dictionary of sequence_type column values.
+    :return: A SequenceTypeKey of the normalised values.
+    """
+    return records.SequenceTypeKey._make(_normalise(fields.get(column)) for column in SEQUENCE_TYPE_COLUMNS)
+
+
+def _normalise(value):
+    # Values read back from the DB might be Decimal or have a different float precision than the ones from the files
+    if isinstance(value, (numbers.Number, decimal.Decimal)) and not isinstance(value, bool):
+        return float('%.*g' % (FLOAT_PRECISION, value))
+    return value
+
+
+def _digest(fingerprint):
+    # The digests stored in the catalog were computed from plain tuples
+    return hashlib.sha1(repr(tuple(fingerprint)).encode()).hexdigest()
+
+
+def _cache_key(table, keys):
+    return (table.name,) + tuple(sorted(keys.items(), key=lambda item: item[0]))
+
+
+def _criteria(table, keys):
+    # Comparing to None is rendered as IS NULL
+    return sql.and_(*[table.c[column] == value for column, value in keys.items()])
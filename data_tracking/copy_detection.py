@@ -0,0 +1,217 @@
+import collections
+import hashlib
+import logging
+import os
+from concurrent import futures
+
+try:
+    import xxhash
+except ImportError:
+    xxhash = None
+
+from . import data_file_writer
+
+
+#######################################################################################################################
+# SETTINGS
+#######################################################################################################################
+
+HASH_ALGORITHM = 'sha1'  # Any hashlib algorithm (e.g. 'blake2b'), or 'xxh64' if the xxhash library is installed
+HASH_BLOCK_SIZE = 1048576  # Size of the buffer reused to read the files being hashed
+EDGE_SIZE = 4096  # Number of bytes read at the beginning and at the end of a file for a partial hash
+STAT_WORKERS = 16  # Number of threads reading the sizes of the files from the previous step
+
+
+#######################################################################################################################
+# PUBLIC FUNCTIONS
+#######################################################################################################################
+
+def hash_file(file_path, algorithm=None, block_size=None):
+    """Compute the hash of a whole file.
+
+    The file is read sequentially into a single reusable buffer, so hashing big files does not allocate memory for
+    each block.
+
+    Arguments:
+    :param file_path: File path.
+    :param algorithm: (optional) Hash algorithm. Default is HASH_ALGORITHM.
+    :param block_size: (optional) Size of the read buffer. Default is HASH_BLOCK_SIZE.
+    :return: The hash (prefixed by the name of the algorithm unless it is SHA-1) or None if the file cannot be read.
+    """
+    algorithm = algorithm or HASH_ALGORITHM
+    hasher = _new_hasher(algorithm)
+    buf = bytearray(block_size or HASH_BLOCK_SIZE)
+    view = memoryview(buf)
+    try:
+        with open(file_path, 'rb', buffering=0) as f:
+            _advise_sequential(f)
+            n = f.readinto(buf)
+            while n:
+                hasher.update(view[:n])
+                n = f.readinto(buf)
+        return _format_hash(algorithm, hasher)
+    except OSError:
+        return None
+
+
+def hash_edges(file_path, algorithm=None):
+    """Compute a partial hash of a file using its size, its first and its last EDGE_SIZE bytes.
+
+    Arguments:
+    :param file_path: File path.
+    :param algorithm: (optional) Hash algorithm. Default is HASH_ALGORITHM.
+    :return: A tuple (size, partial hash) or (None, None) if the file cannot be read.
+    """
+    hasher = _new_hasher(algorithm or HASH_ALGORITHM)
+    try:
+        with open(file_path, 'rb') as f:
+            size = os.fstat(f.fileno()).st_size
+            hasher.update(f.read(EDGE_SIZE))
+            if size > 2 * EDGE_SIZE:
+                f.seek(-EDGE_SIZE, os.SEEK_END)
+            hasher.update(f.read(EDGE_SIZE))
+        hasher.update(str(size).encode())
+        return size, hasher.hexdigest()
+    except OSError:
+        return None, None
+
+
+def find_copy(file_path, edges, candidates, algorithm=None):
+    """Check if a file is a copy of one of the given files (see CopyDetector.get_candidates). This does not need any
+    database connection, so it can safely be run in a worker process.
+
+    Arguments:
+    :param file_path: File path.
+    :param edges: Partial hash of the file (see hash_edges).
+    :param candidates: List of (path, full hash) tuples of the files of the same size. The full hash can be None.
+    :param algorithm: (optional) Hash algorithm. Default is HASH_ALGORITHM.
+    :return: A tuple (is_copy, file_hash, hashes). The full hash of the file is None if it was not needed. hashes
+    holds the full hashes computed for the candidates.
+    """
+    algorithm = algorithm or HASH_ALGORITHM
+    hashes = dict()
+    candidates = [(path, file_hash) for path, file_hash in candidates
+                  if edges is not None and hash_edges(path, algorithm)[1] == edges]
+    if not candidates:
+        return False, None, hashes
+
+    file_hash = hash_file(file_path, algorithm)
+    if file_hash is None:
+        return False, None, hashes
+    for path, candidate_hash in candidates:
+        if candidate_hash is None:
+            candidate_hash = hashes[path] = hash_file(path, algorithm)
+        if candidate_hash == file_hash:
+            return True, file_hash, hashes
+    return False, file_hash, hashes
+
+
+#######################################################################################################################
+# CLASSES
+#######################################################################################################################
+
+class CopyDetector:
+    """Detect files which are copies of a file recorded in a previous processing step.
+
+    Candidates are compared by size first, then by a partial hash of their edges, and only then by a full hash. Most
+    files are thus never read in full. The full hashes of the previous step are taken from the catalog when it stores
+    them, otherwise they are computed when needed (and stored if possible).
+
+    The files are only read by find_copy, which is meant to run in the workers inspecting the files: the detector
+    itself only looks up the candidates of a file and keeps the full hashes found by the workers.
+    """
+
+    def __init__(self, db_conn, step_id, algorithm=None, stat_workers=STAT_WORKERS):
+        """
+        Arguments:
+        :param db_conn: Database connection.
+        :param step_id: Previous processing step ID.
+        :param algorithm: (optional) Hash algorithm. Default is HASH_ALGORITHM.
+        :param stat_workers: (optional) Number of threads reading the sizes of the files from the previous step.
+        """
+        self.db_conn = db_conn
+        self.algorithm = algorithm or HASH_ALGORITHM
+        self.store_hashes = db_conn.data_files.has_hash_column()
+        self.by_size = collections.defaultdict(list)
+        self.hashes = dict()
+
+        data_file = db_conn.DataFile
+        columns = [data_file.path]
+        if self.store_hashes:
+            columns.append(getattr(data_file, data_file_writer.HASH_COLUMN))
+        rows = db_conn.db_session.query(*columns).filter_by(processing_step_id=step_id).all()
+        if not rows:
+            return
+        # The previous step can be on a network file system, where each stat call waits for a round trip
+        with futures.ThreadPoolExecutor(max_workers=stat_workers) as executor:
+            sizes = executor.map(_get_size, [row[0] for row in rows])
+            for row, size in zip(rows, sizes):
+                path = row[0]
+                if size is None:
+                    logging.debug("Cannot find '%s' from previous step" % path)
+                    continue
+                self.by_size[size].append(path)
+                file_hash = row[1] if self.store_hashes else None
+                if file_hash and _get_algorithm(file_hash) == self.algorithm:
+                    self.hashes[path] = file_hash
+
+    def get_candidates(self, size):
+        """Get the files from the previous processing step a file could be a copy of.
+
+        Arguments:
+        :param size: File size.
+        :return: A list of (path, full hash) tuples for the files of this size (the full hash is None if it is not
+        known yet), to give to find_copy. It is empty if the file cannot be a copy.
+        """
+        return [(path, self.hashes.get(path)) for path in self.by_size.get(size, [])]
+
+    def add_hashes(self, hashes):
+        """Keep the full hashes of files from the previous processing step computed by find_copy. They are stored in
+        the catalog if possible.
+
+        Arguments:
+        :param hashes: Dictionary of full hashes indexed by path.
+        """
+        for path, file_hash in hashes.items():
+            if path not in self.hashes and file_hash:
+                self.hashes[path] = file_hash
+                if self.store_hashes:
+                    self.db_conn.data_files.add(path, file_hash=file_hash)
+
+
+#######################################################################################################################
+# PRIVATE FUNCTIONS
+#######################################################################################################################
+
+def _get_size(path):
+    try:
+        return os.stat(path).st_size
+    except OSError:
+        return None
+
+
+def _advise_sequential(f):
+    # Let the kernel read ahead more aggressively (only available on POSIX systems)
+    try:
+        os.posix_fadvise(f.fileno(), 0, 0, os.POSIX_FADV_SEQUENTIAL)
+    except (AttributeError, OSError):
+        pass
+
+
+def _new_hasher(algorithm):
+    if algorithm.startswith('xxh'):
+        if not xxhash:
+            raise ImportError("The xxhash library is required to use the %s algorithm" % algorithm)
+        return getattr(xxhash, algorithm)()
+    return hashlib.new(algorithm)
+
+
+def _format_hash(algorithm, hasher):
+    # SHA-1 hashes are not prefixed to stay compatible with the hashes stored before other algorithms were supported
+    if 'sha1' == algorithm:
+        return hasher.hexdigest()
+    return algorithm + ':' + hasher.hexdigest()
+
+
+def _get_algorithm(file_hash):
+    return file_hash.split(':')[0] if ':' in file_hash else 'sha1'
@@ -0,0 +1,113 @@
+import collections
+import logging
+
+from sqlalchemy.dialects import postgresql
+from sqlalchemy.sql import functions as sql_func
+
+
+#######################################################################################################################
+# SETTINGS
+#######################################################################################################################
+
+COLUMNS = ['type', 'is_copy', 'processing_step_id', 'repetition_id']
+HASH_COLUMN = 'hash'  # Optional column storing the files content hashes
+SELECT_CHUNK_SIZE = 500  # Stay below the maximum number of host parameters allowed by SQLite
+
+
+#######################################################################################################################
+# CLASSES
+#######################################################################################################################
+
+class DataFileWriter:
+    """Buffer the DataFile rows and write them to the database in batches.
+
+    Rows are identified by their path. When a row already exists, only the fields which are defined (not None) are
+    updated.
+    """
+
+    def __init__(self, db_conn, batch_size=1):
+        """
+        Arguments:
+        :param db_conn: Database connection.
+        :param batch_size: (optional) Number of rows buffered before writing them to the database.
+        """
+        self.db_conn = db_conn
+        self.batch_size = max(batch_size, 1)
+        self.pending = collections.OrderedDict()
+        self.columns = list(COLUMNS)
+        if self.has_hash_column():
+            self.columns.append(HASH_COLUMN)
+
+    def has_hash_column(self):
+        """Check if the data_file table of the catalog can store the files content hashes."""
+        return HASH_COLUMN in self.db_conn.DataFile.__table__.c
+
+    def add(self, path, file_type=None, is_copy=None, step_id=None, repetition_id=None, file_hash=None):
+        """Buffer a DataFile row. The buffer is written to the database when it is full.
+
+        Arguments:
+        :param path: File path.
+        :param file_type: (optional) File type.
+        :param is_copy: (optional) Indicate if this file is a copy.
+        :param step_id: (optional) Processing step ID.
+        :param repetition_id: (optional) Repetition ID.
+        :param file_hash: (optional) File content hash. It is ignored if the catalog cannot store it.
+        """
+        row = {
+            'path': path,
+            'type': file_type if file_type else None,
+            'is_copy': is_copy,
+            'processing_step_id': step_id,
+            'repetition_id': repetition_id
+        }
+        if HASH_COLUMN in self.columns:
+            row[HASH_COLUMN] = file_hash
+        if path in self.pending:
+            self.pending[path].update({k: v for k, v in row.items() if v is not None})
+        else:
+            self.pending[path] = row
+        if len(self.pending) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        """Write all the buffered rows to the database. They are committed with the connection (see Connection.commit).
+
+        :return: Number of rows written.
+        """
+        if not self.pending:
+            return 0
+        rows = list(self.pending.values())
+        table = self.db_conn.DataFile.__table__
+        if 'postgresql' == self.db_conn.engine.dialect.name and self.db_conn.has_unique_key(table, 'path'):
+            self._upsert(table, rows)
+        else:
+            self._merge(rows)
+        self.pending.clear()
+        logging.debug("%s data files written to the database" % len(rows))
+        return len(rows)
+
+    def _upsert(self, table, rows):
+        stmt = postgresql.insert(table).values(rows)
+        stmt = stmt.on_conflict_do_update(
+            index_elements=[table.c.path],
+            set_={col: sql_func.coalesce(stmt.excluded[col], table.c[col]) for col in self.columns}
+        )
+        self.db_conn.db_session.execute(stmt)
+
+    def _merge(self, rows):
+        data_file = self.db_conn.DataFile
+        paths = [row['path'] for row in rows]
+        existing = dict()
+        for i in range(0, len(paths), SELECT_CHUNK_SIZE):
+            existing.update(self.db_conn.db_session.query(data_file.path, data_file.id).filter(
+                data_file.path.in_(paths[i:i + SELECT_CHUNK_SIZE])))
+
+        new_rows = [row for row in rows if row['path'] not in existing]
+        updated_rows = [
+            dict({k: v for k, v in row.items() if v is not None and k in self.columns}, id=existing[row['path']])
+            for row in rows if row['path'] in existing
+        ]
+        if new_rows:
+            self.db_conn.db_session.bulk_insert_mappings(data_file, new_rows)
+        if updated_rows:
+            self.db_conn.db_session.bulk_update_mappings(data_file, updated_rows)
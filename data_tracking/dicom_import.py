@@ -1,15 +1,84 @@
 import logging
 import re
 
+import numpy
+
 from sqlalchemy.exc import IntegrityError
 
 # dicom refers to pydicom library
-import dicom
 from dicom.errors import InvalidDicomError
+from dicom.filereader import read_partial
 
+from . import connection
+from . import records
 from . import utils
 
 
+#######################################################################################################################
+# SETTINGS
+#######################################################################################################################
+
+# Tags read from the DICOM headers. Files are parsed until the last of them, the others are dropped.
+HEADER_TAGS = {
+    0x00080021: 'SeriesDate',
+    0x00080022: 'AcquisitionDate',
+    0x00080070: 'Manufacturer',
+    0x00080080: 'InstitutionName',
+    0x0008103E: 'SeriesDescription',
+    0x00081090: 'ManufacturerModelName',
+    0x00100020: 'PatientID',
+    0x00100030: 'PatientBirthDate',
+    0x00100040: 'PatientSex',
+    0x00101010: 'PatientAge',
+    0x00180050: 'SliceThickness',
+    0x00180080: 'RepetitionTime',
+    0x00180081: 'EchoTime',
+    0x00180086: 'EchoNumbers',
+    0x00180087: 'MagneticFieldStrength',
+    0x00180088: 'SpacingBetweenSlices',
+    0x00180089: 'NumberOfPhaseEncodingSteps',
+    0x00180091: 'EchoTrainLength',
+    0x00180093: 'PercentSampling',
+    0x00180094: 'PercentPhaseFieldOfView',
+    0x00180095: 'PixelBandwidth',
+    0x00181030: 'ProtocolName',
+    0x00181314: 'FlipAngle',
+    0x0020000D: 'StudyInstanceUID',
+    0x0020000E: 'SeriesInstanceUID',
+    0x00200010: 'StudyID',
+    0x00200011: 'SeriesNumber',
+    0x00280010: 'Rows',
+    0x00280011: 'Columns',
+    0x00280030: 'PixelSpacing',
+}
+LAST_HEADER_TAG = max(HEADER_TAGS)
+DEFER_SIZE = 1024  # Values bigger than this (e.g. private tags before the last header tag) are not loaded
+
+# Sequence type fields: (name, DICOM keywords tried in turn, type). A keyword can be a (keyword, index) tuple.
+SEQUENCE_TYPE_FIELDS = [
+    ('sequence_name', ['SeriesDescription', 'ProtocolName'], None),  # SeriesDescription seems better than ProtocolName
+    ('manufacturer', ['Manufacturer'], None),
+    ('manufacturer_model_name', ['ManufacturerModelName'], None),
+    ('institution_name', ['InstitutionName'], None),
+    ('slice_thickness', ['SliceThickness'], float),
+    ('repetition_time', ['RepetitionTime'], float),
+    ('echo_time', ['EchoTime'], float),
+    ('number_of_phase_encoding_steps', ['NumberOfPhaseEncodingSteps'], int),
+    ('percent_phase_field_of_view', ['PercentPhaseFieldOfView'], float),
+    ('pixel_bandwidth', ['PixelBandwidth'], int),
+    ('flip_angle', ['FlipAngle'], float),
+    ('rows', ['Rows'], int),
+    ('columns', ['Columns'], int),
+    ('magnetic_field_strength', ['MagneticFieldStrength'], float),
+    ('echo_train_length', ['EchoTrainLength'], int),
+    ('percent_sampling', ['PercentSampling'], float),
+    ('pixel_spacing_0', [('PixelSpacing', 0)], float),
+    ('pixel_spacing_1', [('PixelSpacing', 1)], float),
+    ('echo_number', ['EchoNumber'], int),  # Not a DICOM keyword (EchoNumbers is), kept to match the recorded types
+    ('space_between_slices', ['SpacingBetweenSlices'], float),
+]
+
+
 #######################################################################################################################
 # GLOBAL VARIABLES
 #######################################################################################################################
@@ -23,9 +92,12 @@ conn = None
 
 
 def dicom2db(file_path, file_type, is_copy, step_id, db_conn, sid_by_patient=False, pid_in_vid=False,
-             visit_in_path=False, rep_in_path=False):
+             visit_in_path=False, rep_in_path=False, dcm=None, file_hash=None, sequence_type_id=None):
     """Extract some meta-data from a DICOM file and store in a DB.
 
+    Note:
+    The changes are not committed (see Connection.commit).
+
     Arguments:
     :param file_path: File path.
     :param file_type: File type (should be 'DICOM').
@@ -41,8 +113,12 @@ def dicom2db(file_path, file_type, is_copy, step_id, db_conn, sid_by_patient=Fal
     (e.g. can be useful for PPMI).
     :param rep_in_path: Enable this flag to get the repetition ID from the folder hierarchy instead of DICOM meta-data
     (e.g. can be useful for PPMI).
+    :param dcm: (optional) DICOM header already read from the file (see read_header). If not defined, the file is
+    read here.
+    :param file_hash: (optional) File content hash.
+    :param sequence_type_id: (optional) Sequence type ID, if already resolved (see get_sequence_type_ids).
     :return: A dictionary containing the following IDs : participant_id, visit_id, session_id, sequence_type_id,
-    sequence_id, repetition_id, file_id.
+    sequence_id, repetition_id. It is empty if the file could not be recorded.
     """
     global conn
     conn = db_conn
@@ -50,53 +126,185 @@ def dicom2db(file_path, file_type, is_copy, step_id, db_conn, sid_by_patient=Fal
     tags = dict()
     logging.info("Extracting DICOM headers from '%s'" % file_path)
 
-    try:
-        dcm = dicom.read_file(file_path)
-        dataset = db_conn.get_dataset(step_id)
-
-        tags['participant_id'] = _extract_participant(dcm, dataset, pid_in_vid)
-        if visit_in_path:
-            tags['visit_id'] = _extract_visit_from_path(
-                dcm, file_path, pid_in_vid, sid_by_patient, dataset, tags['participant_id'])
-        else:
-            tags['visit_id'] = _extract_visit(dcm, dataset, tags['participant_id'], sid_by_patient, pid_in_vid)
-        tags['session_id'] = _extract_session(dcm, tags['visit_id'])
-        tags['sequence_type_id'] = _extract_sequence_type(dcm)
-        tags['sequence_id'] = _extract_sequence(tags['session_id'], tags['sequence_type_id'])
-        if rep_in_path:
-            tags['repetition_id'] = _extract_repetition_from_path(dcm, file_path, tags['sequence_id'])
-        else:
-            tags['repetition_id'] = _extract_repetition(dcm, tags['sequence_id'])
-        tags['file_id'] = extract_dicom(file_path, file_type, is_copy, tags['repetition_id'], step_id)
-    except InvalidDicomError:
-        logging.warning("%s is not a DICOM file !" % step_id)
+    if dcm is None:
+        dcm = read_header(file_path)
+        if dcm is None:
+            return tags
+
+    try:
+        # All the changes made for this file are rolled back together if one of them fails
+        with conn.db_session.begin_nested():
+            dataset = db_conn.get_dataset(step_id)
+
+            tags['participant_id'] = _extract_participant(dcm, dataset, pid_in_vid)
+            if visit_in_path:
+                tags['visit_id'] = _extract_visit_from_path(
+                    dcm, file_path, pid_in_vid, sid_by_patient, dataset, tags['participant_id'])
+            else:
+                tags['visit_id'] = _extract_visit(dcm, dataset, tags['participant_id'], sid_by_patient, pid_in_vid)
+            tags['session_id'] = _extract_session(dcm, tags['visit_id'])
+            sequence_type_fields = _extract_sequence_type_fields(dcm)
+            if sequence_type_id is None:
+                sequence_type_id = _extract_sequence_type(sequence_type_fields)
+            tags['sequence_type_id'] = sequence_type_id
+            tags['sequence_id'] = _extract_sequence(
+                tags['session_id'], tags['sequence_type_id'], sequence_type_fields['sequence_name'])
+            if rep_in_path:
+                tags['repetition_id'] = _extract_repetition_from_path(dcm, file_path, tags['sequence_id'])
+            else:
+                tags['repetition_id'] = _extract_repetition(dcm, tags['sequence_id'])
+            extract_dicom(file_path, file_type, is_copy, tags['repetition_id'], step_id, file_hash)
     except IntegrityError:
         # TODO: properly deal with concurrency problems
-        logging.warning("A problem occurred with the DB ! A rollback will be performed...")
-        conn.db_session.rollback()
+        logging.warning("A problem occurred with the DB ! The changes made for %s were rolled back..." % file_path)
+        tags = dict()
     return tags
 
 
-def extract_dicom(path, file_type, is_copy, repetition_id, processing_step_id):
-    df = conn.db_session.query(conn.DataFile).filter_by(path=path).one_or_none()
+def read_header(file_path):
+    """Read the header of a DICOM file. This can safely be run in a worker process.
+
+    Only the tags listed in HEADER_TAGS are kept. The file is not read beyond the last of them, so the pixel data is
+    never loaded.
+
+    Arguments:
+    :param file_path: File path.
+    :return: A SeriesHeader holding the values of the tags or None if the file cannot be parsed.
+    """
+    try:
+        with open(file_path, 'rb') as f:
+            dcm = read_partial(f, _after_last_header_tag, defer_size=DEFER_SIZE)
+    except InvalidDicomError:
+        logging.warning("%s is not a DICOM file !" % file_path)
+        return None
+    header = records.SeriesHeader()
+    for tag, keyword in HEADER_TAGS.items():
+        if tag in dcm:
+            setattr(header, keyword, _plain_value(dcm[tag].value))
+    return header
+
+
+def get_series_uids(dcm):
+    """Get the identifiers of the study and the series a DICOM file belongs to.
+
+    Arguments:
+    :param dcm: DICOM header (see read_header).
+    :return: A tuple (StudyInstanceUID, SeriesInstanceUID). Missing values are None.
+    """
+    return getattr(dcm, 'StudyInstanceUID', None), getattr(dcm, 'SeriesInstanceUID', None)
+
+
+def extract_dicom(path, file_type, is_copy, repetition_id, processing_step_id, file_hash=None):
+    """Record a DICOM file whose repetition is already known. The row is buffered by the connection data files writer.
 
-    if not df:
-        df = conn.DataFile(
-            path=path,
-            type=file_type,
-            repetition_id=repetition_id,
-            processing_step_id=processing_step_id,
-            is_copy=is_copy
-        )
-        conn.db_session.merge(df)
-    else:
-        df.file_type = file_type
-        df.repetition_id = repetition_id
-        df.processing_step_id = processing_step_id
-        df.is_copy = is_copy
-    conn.db_session.commit()
+    Arguments:
+    :param path: File path.
+    :param file_type: File type (should be 'DICOM').
+    :param is_copy: Indicate if this file is a copy.
+    :param repetition_id: Repetition ID.
+    :param processing_step_id: Step ID.
+    :param file_hash: (optional) File content hash.
+    """
+    conn.data_files.add(path, file_type, is_copy, processing_step_id, repetition_id, file_hash)
+
+
+def extract_sequence_types(datasets):
+    """Extract the sequence type fields of a batch of DICOM data sets into columns.
+
+    Arguments:
+    :param datasets: List of DICOM headers (see read_header) or pydicom data sets.
+    :return: A SequenceTypeColumns.
+    """
+    return SequenceTypeColumns(datasets)
 
-    return conn.db_session.query(conn.DataFile).filter_by(path=path).one_or_none().id
+
+def get_sequence_type_ids(datasets, db_conn):
+    """Get (or create) the sequence type IDs of a batch of DICOM data sets (e.g. all the files of a series).
+
+    The batch is deduplicated first, so each distinct sequence type is resolved once.
+
+    Note:
+    The changes are not committed (see Connection.commit).
+
+    Arguments:
+    :param datasets: List of DICOM headers (see read_header) or pydicom data sets.
+    :param db_conn: Database connection.
+    :return: List of sequence type IDs, in the order of the data sets.
+    """
+    columns = extract_sequence_types(datasets)
+    first_rows, inverse = columns.unique_rows()
+    ids = []
+    for row in first_rows:
+        fields = columns.row(row)
+        fields['name'] = fields.pop('sequence_name')
+        ids.append(db_conn.get_sequence_type_id(fields))
+    return [ids[i] for i in inverse]
+
+
+#######################################################################################################################
+# CLASSES
+#######################################################################################################################
+
+class SequenceTypeColumns:
+    """Sequence type fields of a batch of DICOM data sets, stored by column.
+
+    Numeric fields are NumPy arrays with a mask of the values which are present. Other fields are lists.
+    """
+
+    def __init__(self, datasets):
+        """
+        Arguments:
+        :param datasets: List of DICOM headers (see read_header) or pydicom data sets.
+        """
+        self.size = len(datasets)
+        self.values = dict()
+        self.present = dict()
+        for column, keywords, convert in SEQUENCE_TYPE_FIELDS:
+            values = [_get_value(dcm, keywords, convert) for dcm in datasets]
+            if convert in (int, float):
+                present = numpy.array([v is not None for v in values], dtype=bool)
+                self.values[column] = numpy.array([v if v is not None else 0 for v in values], dtype=convert)
+                self.present[column] = present
+            else:
+                self.values[column] = values
+
+    def row(self, i):
+        """Get the fields of a data set as Python values (None when missing)."""
+        fields = dict()
+        for column, _, convert in SEQUENCE_TYPE_FIELDS:
+            if column in self.present:
+                fields[column] = convert(self.values[column][i]) if self.present[column][i] else None
+            else:
+                fields[column] = self.values[column][i]
+        return fields
+
+    def unique_rows(self):
+        """Find the distinct sequence types, once normalised (see connection.sequence_type_fingerprint).
+
+        :return: A tuple (index of the first data set of each distinct sequence type, index of the distinct sequence
+        type of each data set).
+        """
+        if not self.size:
+            return [], []
+        keys = []
+        for column, _, convert in SEQUENCE_TYPE_FIELDS:
+            if column in self.present:
+                present = self.present[column]
+                values = self.values[column].astype(float)
+                if float == convert:
+                    values = _round_significant(values, present)
+                keys.append(numpy.where(present, values, 0.0))
+                keys.append(present.astype(float))
+            else:
+                # Encode the other values as integers, in order of appearance
+                codes = dict()
+                keys.append(numpy.array([codes.setdefault(v, len(codes)) for v in self.values[column]], dtype=float))
+        _, first_rows, inverse = numpy.unique(
+            numpy.column_stack(keys), axis=0, return_index=True, return_inverse=True)
+        order = numpy.argsort(first_rows)
+        rank = numpy.empty_like(order)
+        rank[order] = numpy.arange(len(order))
+        return [int(i) for i in first_rows[order]], [int(i) for i in rank[numpy.ravel(inverse)]]
 
 
 #######################################################################################################################
@@ -104,6 +312,10 @@ def extract_dicom(path, file_type, is_copy, repetition_id, processing_step_id):
 #######################################################################################################################
 
 
+def _after_last_header_tag(tag, *_):
+    return tag > LAST_HEADER_TAG
+
+
 def _extract_participant(dcm, dataset, pid_in_vid=False):
     try:
         participant_name = dcm.PatientID
@@ -128,23 +340,10 @@ def _extract_participant(dcm, dataset, pid_in_vid=False):
 
     participant_id = conn.get_participant_id(participant_name, dataset)
 
-    participant = conn.db_session.query(
-        conn.Participant).filter_by(id=participant_id).one_or_none()
-
-    if not participant:
-        participant = conn.Participant(
-            id=participant_id,
-            gender=participant_gender,
-            birth_date=participant_birth_date,
-        )
-        conn.db_session.merge(participant)
-    else:
-        participant.gender = participant_gender
-        participant.birth_date = participant_birth_date
-    conn.db_session.commit()
-
-    return conn.db_session.query(
-        conn.Participant).filter_by(id=participant_id).one_or_none().id
+    return conn.upsert(conn.Participant, {'id': participant_id}, {
+        'gender': participant_gender,
+        'birth_date': participant_birth_date
+    })
 
 
 def _extract_visit(dcm, dataset, participant_id, by_patient=False, pid_in_vid=False):
@@ -179,23 +378,11 @@ def _extract_visit(dcm, dataset, participant_id, by_patient=False, pid_in_vid=Fa
 
     visit_id = conn.get_visit_id(visit_name, dataset)
 
-    visit = conn.db_session.query(conn.Visit).filter_by(id=visit_id).one_or_none()
-
-    if not visit:
-        visit = conn.Visit(
-            id=visit_id,
-            date=scan_date,
-            participant_id=participant_id,
-            patient_age=participant_age
-        )
-        conn.db_session.merge(visit)
-    else:
-        visit.date = scan_date
-        visit.participant_id = participant_id
-        visit.patient_age = participant_age
-    conn.db_session.commit()
-
-    return conn.db_session.query(conn.Visit).filter_by(id=visit_id).one_or_none().id
+    return conn.upsert(conn.Visit, {'id': visit_id}, {
+        'date': scan_date,
+        'participant_id': participant_id,
+        'patient_age': participant_age
+    })
 
 
 def _extract_session(dcm, visit_id):
@@ -205,227 +392,70 @@ def _extract_session(dcm, visit_id):
         logging.debug("Field StudyID was not found")
         session_value = None
 
-    session = conn.db_session.query(conn.Session).filter_by(
-        visit_id=visit_id, name=session_value).first()
-
-    if not session:
-        session = conn.Session(
-            visit_id=visit_id,
-            name=session_value,
-        )
-        conn.db_session.merge(session)
-        conn.db_session.commit()
-
-    return conn.db_session.query(conn.Session).filter_by(
-        visit_id=visit_id, name=session_value).first().id
-
-
-def _extract_sequence_type(dcm):
-    fields = _extract_sequence_type_fields(dcm)
-
-    sequence_type = conn.db_session.query(conn.SequenceType).filter_by(
-        name=fields['sequence_name'],
-        manufacturer=fields['manufacturer'],
-        manufacturer_model_name=fields['manufacturer_model_name'],
-        institution_name=fields['institution_name'],
-        slice_thickness=fields['slice_thickness'],
-        repetition_time=fields['repetition_time'],
-        echo_time=fields['echo_time'],
-        echo_number=fields['echo_number'],
-        number_of_phase_encoding_steps=fields['number_of_phase_encoding_steps'],
-        percent_phase_field_of_view=fields['percent_phase_field_of_view'],
-        pixel_bandwidth=fields['pixel_bandwidth'],
-        flip_angle=fields['flip_angle'],
-        rows=fields['rows'],
-        columns=fields['columns'],
-        magnetic_field_strength=fields['magnetic_field_strength'],
-        space_between_slices=fields['space_between_slices'],
-        echo_train_length=fields['echo_train_length'],
-        percent_sampling=fields['percent_sampling'],
-        pixel_spacing_0=fields['pixel_spacing_0'],
-        pixel_spacing_1=fields['pixel_spacing_1']
-    ).one_or_none()
-
-    if not sequence_type:
-        sequence_type = conn.SequenceType(
-            name=fields['sequence_name'],
-            manufacturer=fields['manufacturer'],
-            manufacturer_model_name=fields['manufacturer_model_name'],
-            institution_name=fields['institution_name'],
-            slice_thickness=fields['slice_thickness'],
-            repetition_time=fields['repetition_time'],
-            echo_time=fields['echo_time'],
-            echo_number=fields['echo_number'],
-            number_of_phase_encoding_steps=fields['number_of_phase_encoding_steps'],
-            percent_phase_field_of_view=fields['percent_phase_field_of_view'],
-            pixel_bandwidth=fields['pixel_bandwidth'],
-            flip_angle=fields['flip_angle'],
-            rows=fields['rows'],
-            columns=fields['columns'],
-            magnetic_field_strength=fields['magnetic_field_strength'],
-            space_between_slices=fields['space_between_slices'],
-            echo_train_length=fields['echo_train_length'],
-            percent_sampling=fields['percent_sampling'],
-            pixel_spacing_0=fields['pixel_spacing_0'],
-            pixel_spacing_1=fields['pixel_spacing_1']
-        )
-        conn.db_session.merge(sequence_type)
-        conn.db_session.commit()
-
-    return conn.db_session.query(conn.SequenceType).filter_by(
-        name=fields['sequence_name'],
-        manufacturer=fields['manufacturer'],
-        manufacturer_model_name=fields['manufacturer_model_name'],
-        institution_name=fields['institution_name'],
-        slice_thickness=fields['slice_thickness'],
-        repetition_time=fields['repetition_time'],
-        echo_time=fields['echo_time'],
-        echo_number=fields['echo_number'],
-        number_of_phase_encoding_steps=fields['number_of_phase_encoding_steps'],
-        percent_phase_field_of_view=fields['percent_phase_field_of_view'],
-        pixel_bandwidth=fields['pixel_bandwidth'],
-        flip_angle=fields['flip_angle'],
-        rows=fields['rows'],
-        columns=fields['columns'],
-        magnetic_field_strength=fields['magnetic_field_strength'],
-        space_between_slices=fields['space_between_slices'],
-        echo_train_length=fields['echo_train_length'],
-        percent_sampling=fields['percent_sampling'],
-        pixel_spacing_0=fields['pixel_spacing_0'],
-        pixel_spacing_1=fields['pixel_spacing_1']
-    ).one_or_none().id
+    return conn.get_or_create_id(conn.Session, {'visit_id': visit_id, 'name': session_value})
+
+
+def _extract_sequence_type(sequence_type_fields):
+    fields = dict(sequence_type_fields)
+    fields['name'] = fields.pop('sequence_name')
+    return conn.get_sequence_type_id(fields)
 
 
 def _extract_sequence_type_fields(dcm):
     fields = dict()
-    try:
-        fields['sequence_name'] = dcm.SeriesDescription  # It seems better to use this instead of ProtocolName
-    except AttributeError:
-        logging.debug("Field SeriesDescription was not found")
-        try:
-            fields['sequence_name'] = dcm.ProtocolName  # If SeriesDescription is missing, we use ProtocolName
-        except AttributeError:
-            fields['sequence_name'] = None
-    try:
-        fields['manufacturer'] = dcm.Manufacturer
-    except AttributeError:
-        logging.debug("Field Manufacturer was not found")
-        fields['manufacturer'] = None
-    try:
-        fields['manufacturer_model_name'] = dcm.ManufacturerModelName
-    except AttributeError:
-        logging.debug("Field ManufacturerModelName was not found")
-        fields['manufacturer_model_name'] = None
-    try:
-        fields['institution_name'] = dcm.InstitutionName
-    except AttributeError:
-        logging.debug("Field InstitutionName was not found")
-        fields['institution_name'] = None
-    try:
-        fields['slice_thickness'] = float(dcm.SliceThickness)
-    except (AttributeError, ValueError):
-        logging.debug("Field SliceThickness was not found")
-        fields['slice_thickness'] = None
-    try:
-        fields['repetition_time'] = float(dcm.RepetitionTime)
-    except (AttributeError, ValueError):
-        logging.debug("Field RepetitionTime was not found")
-        fields['repetition_time'] = None
-    try:
-        fields['echo_time'] = float(dcm.EchoTime)
-    except (AttributeError, ValueError):
-        logging.debug("Field EchoTime was not found")
-        fields['echo_time'] = None
-    try:
-        fields['number_of_phase_encoding_steps'] = int(dcm.NumberOfPhaseEncodingSteps)
-    except (AttributeError, ValueError):
-        logging.debug("Field NumberOfPhaseEncodingSteps was not found")
-        fields['number_of_phase_encoding_steps'] = None
-    try:
-        fields['percent_phase_field_of_view'] = float(dcm.PercentPhaseFieldOfView)
-    except (AttributeError, ValueError):
-        logging.debug("Field PercentPhaseFieldOfView was not found")
-        fields['percent_phase_field_of_view'] = None
-    try:
-        fields['pixel_bandwidth'] = int(dcm.PixelBandwidth)
-    except (AttributeError, ValueError):
-        logging.debug("Field PixelBandwidth was not found")
-        fields['pixel_bandwidth'] = None
-    try:
-        fields['flip_angle'] = float(dcm.FlipAngle)
-    except (AttributeError, ValueError):
-        logging.debug("Field FlipAngle was not found")
-        fields['flip_angle'] = None
-    try:
-        fields['rows'] = int(dcm.Rows)
-    except (AttributeError, ValueError):
-        logging.debug("Field Rows was not found")
-        fields['rows'] = None
-    try:
-        fields['columns'] = int(dcm.Columns)
-    except (AttributeError, ValueError):
-        logging.debug("Field Columns was not found")
-        fields['columns'] = None
-    try:
-        fields['magnetic_field_strength'] = float(dcm.MagneticFieldStrength)
-    except (AttributeError, ValueError):
-        logging.debug("Field MagneticFieldStrength was not found")
-        fields['magnetic_field_strength'] = None
-    try:
-        fields['echo_train_length'] = int(dcm.EchoTrainLength)
-    except (AttributeError, ValueError):
-        logging.debug("Field EchoTrainLength was not found")
-        fields['echo_train_length'] = None
-    try:
-        fields['percent_sampling'] = float(dcm.PercentSampling)
-    except (AttributeError, ValueError):
-        logging.debug("Field PercentSampling was not found")
-        fields['percent_sampling'] = None
-    try:
-        pixel_spacing = dcm.PixelSpacing
-    except AttributeError:
-        logging.debug("Field PixelSpacing was not found")
-        pixel_spacing = None
-    try:
-        fields['pixel_spacing_0'] = float(pixel_spacing[0])
-    except (AttributeError, ValueError, TypeError):
-        logging.debug("Field pixel_spacing0 was not found")
-        fields['pixel_spacing_0'] = None
-    try:
-        fields['pixel_spacing_1'] = float(pixel_spacing[1])
-    except (AttributeError, ValueError, TypeError):
-        logging.debug("Field pixel_spacing1 was not found")
-        fields['pixel_spacing_1'] = None
-    try:
-        fields['echo_number'] = int(dcm.EchoNumber)
-    except (AttributeError, ValueError):
-        logging.debug("Field echo_number was not found")
-        fields['echo_number'] = None
-    try:
-        fields['space_between_slices'] = float(dcm[0x0018, 0x0088].value)
-    except (AttributeError, ValueError, KeyError):
-        logging.debug("Field space_between_slices was not found")
-        fields['space_between_slices'] = None
+    missing = []
+    for column, keywords, convert in SEQUENCE_TYPE_FIELDS:
+        fields[column] = _get_value(dcm, keywords, convert)
+        if fields[column] is None:
+            missing.append(column)
+    if missing:
+        logging.debug("Fields not found: %s" % ", ".join(missing))
     return fields
 
 
-def _extract_sequence(session_id, sequence_type_id):
-    name = conn.db_session.query(conn.SequenceType).filter_by(id=sequence_type_id).one_or_none().name
-    sequence = conn.db_session.query(conn.Sequence).filter_by(session_id=session_id, name=name).one_or_none()
-
-    if not sequence:
-        sequence = conn.Sequence(
-            name=name,
-            session_id=session_id,
-            sequence_type_id=sequence_type_id,
-        )
-        conn.db_session.merge(sequence)
-
-    else:
-        sequence.sequence_type_id = sequence_type_id
-    conn.db_session.commit()
-
-    return conn.db_session.query(conn.Sequence).filter_by(session_id=session_id, name=name).one_or_none().id
+def _get_value(dcm, keywords, convert=None):
+    # The keywords are alternatives: the first one found is used
+    for keyword in keywords:
+        index = None
+        if isinstance(keyword, tuple):
+            keyword, index = keyword
+        try:
+            value = getattr(dcm, keyword)
+            if index is not None:
+                value = value[index]
+            return convert(value) if convert else value
+        except (AttributeError, ValueError, TypeError, IndexError):
+            continue
+    return None
+
+
+def _plain_value(value):
+    # Replace the pydicom value types (DSfloat, IS, MultiValue, PersonName, ...) by built-in ones
+    if value is None or isinstance(value, (bytes, bool)):
+        return value
+    if isinstance(value, float):
+        return float(value)
+    if isinstance(value, int):
+        return int(value)
+    if isinstance(value, str):
+        return str(value)
+    if isinstance(value, (list, tuple)) or type(value).__name__ == 'MultiValue':
+        return [_plain_value(v) for v in value]
+    return str(value)
+
+
+def _round_significant(values, present):
+    # Vectorised equivalent of connection._normalise
+    rounded = values.copy()
+    nonzero = present & (values != 0) & numpy.isfinite(values)
+    magnitude = numpy.floor(numpy.log10(numpy.abs(values[nonzero])))
+    factor = 10.0 ** (connection.FLOAT_PRECISION - 1 - magnitude)
+    rounded[nonzero] = numpy.round(values[nonzero] * factor) / factor
+    return rounded
+
+
+def _extract_sequence(session_id, sequence_type_id, name):
+    return conn.upsert(conn.Sequence, {'session_id': session_id, 'name': name}, {'sequence_type_id': sequence_type_id})
 
 
 def _extract_repetition(dcm, sequence_id):
@@ -441,22 +471,7 @@ def _extract_repetition(dcm, sequence_id):
     except AttributeError:
         series_date = None
 
-    repetition = conn.db_session.query(conn.Repetition).filter_by(
-        sequence_id=sequence_id, name=repetition_name).one_or_none()
-
-    if not repetition:
-        repetition = conn.Repetition(
-            sequence_id=sequence_id,
-            name=repetition_name,
-            date=series_date
-        )
-        conn.db_session.merge(repetition)
-    else:
-        repetition.date = series_date
-    conn.db_session.commit()
-
-    return conn.db_session.query(conn.Repetition).filter_by(
-        sequence_id=sequence_id, name=repetition_name).one_or_none().id
+    return conn.upsert(conn.Repetition, {'sequence_id': sequence_id, 'name': repetition_name}, {'date': series_date})
 
 
 def _extract_visit_from_path(dcm, file_path, pid_in_vid, by_patient, dataset, participant_id):
@@ -489,21 +504,7 @@ def _extract_visit_from_path(dcm, file_path, pid_in_vid, by_patient, dataset, pa
 
     visit_id = conn.get_visit_id(visit_name, dataset)
 
-    visit = conn.db_session.query(conn.Visit).filter_by(id=visit_id).one_or_none()
-
-    if not visit:
-        visit = conn.Visit(
-            id=visit_id,
-            date=scan_date,
-            participant_id=participant_id,
-        )
-        conn.db_session.merge(visit)
-    else:
-        visit.date = scan_date
-        visit.participant_id = participant_id
-        conn.db_session.commit()
-
-    return conn.db_session.query(conn.Visit).filter_by(id=visit_id).one_or_none().id
+    return conn.upsert(conn.Visit, {'id': visit_id}, {'date': scan_date, 'participant_id': participant_id})
 
 
 def _extract_repetition_from_path(dcm, file_path, sequence_id):
@@ -515,19 +516,4 @@ def _extract_repetition_from_path(dcm, file_path, sequence_id):
     except AttributeError:
         series_date = None
 
-    repetition = conn.db_session.query(conn.Repetition).filter_by(
-        sequence_id=sequence_id, name=repetition_name).one_or_none()
-
-    if not repetition:
-        repetition = conn.Repetition(
-            sequence_id=sequence_id,
-            name=repetition_name,
-            date=series_date
-        )
-        conn.db_session.merge(repetition)
-    else:
-        repetition.date = series_date
-        conn.db_session.commit()
-
-    return conn.db_session.query(conn.Repetition).filter_by(
-        sequence_id=sequence_id, name=repetition_name).one_or_none().id
+    return conn.upsert(conn.Repetition, {'sequence_id': sequence_id, 'name': repetition_name}, {'date': series_date})
@@ -1,11 +1,11 @@
 import builtins
+import collections
 import logging
 import os
 import datetime
-import glob
-import hashlib
-import sys
-import fnmatch
+import gzip
+import struct
+from concurrent import futures
 
 # magic refers to the python-magic library
 import magic
@@ -13,24 +13,48 @@ import magic
 import nibabel
 from nibabel import filebasedimages
 
+from sqlalchemy import sql
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.sql import functions as sql_func
+
+from . import cache
+from . import checkpoints
 from . import connection
+from . import copy_detection
 from . import dicom_import
+from . import fingerprints
 from . import nifti_import
 from . import others_import
+from . import path_layouts
+from . import pipeline
+from . import records
+from . import walker
 
 
 ##########################################################################
 # SETTINGS
 ##########################################################################
 
-HASH_BLOCK_SIZE = 65536  # Avoid getting out of memory when hashing big files
+PREFETCH_FACTOR = 4  # Number of files submitted in advance to each worker
+DATA_FILE_BATCH_SIZE = 1000  # Number of files recorded in the database at once
+CHECKPOINT_INTERVAL = 10000  # Minimum number of files recorded between two checkpoints
+DELETE_CHUNK_SIZE = 500  # Number of paths per DELETE statement (SQLite limits the number of host parameters)
+SNIFF_SIZE = 544  # Number of bytes read to recognize a file (enough for a NIfTI-2 header)
+SESSION_RECYCLE_INTERVAL = 100000  # Number of files recorded before the database session is replaced by a new one
+LOW_MEMORY_BATCH_SIZE = 100  # Maximum batch size in low memory mode
+LOW_MEMORY_CACHE_SIZE = 1000  # Number of IDs and DICOM series kept in memory in low memory mode
+LOW_MEMORY_RECYCLE_INTERVAL = 10000  # Maximum session recycle interval in low memory mode
 
 
 ##########################################################################
 # PUBLIC FUNCTIONS
 ##########################################################################
 
-def visit(folder, provenance_id, step_name, previous_step_id=None, config=None, db_url=None, is_organised=True):
+def visit(folder, provenance_id, step_name, previous_step_id=None, config=None, db_url=None, is_organised=True,
+          workers=None, executor=None, batch_size=DATA_FILE_BATCH_SIZE, fingerprint_index=None,
+          include=None, exclude=None, max_depth=None, stage_workers=None, pipeline_stats=None, shard=None,
+          shard_by='folder', checkpoint=None, resume=False, checkpoint_interval=CHECKPOINT_INTERVAL, nifti_layout=None,
+          recycle_interval=SESSION_RECYCLE_INTERVAL, low_memory=False):
     """Record all files from a folder into the database.
 
     Note:
@@ -45,8 +69,9 @@ def visit(folder, provenance_id, step_name, previous_step_id=None, config=None,
     :param previous_step_id: (optional) previous processing step ID. If not defined, we assume this is the first
     processing step.
     :param config: List of flags:
-        - boost: (optional) When enabled, we consider that all the files from a same folder share the same meta-data.
-        When enabled, the processing is (about 2 times) faster. This option is enabled by default.
+        - boost: (optional) When enabled, we consider that all the files from a same folder and a same DICOM series
+        (StudyInstanceUID and SeriesInstanceUID) share the same meta-data. When enabled, the processing is (about 2
+        times) faster. This option is enabled by default.
         - session_id_by_patient: Rarely, a data set might use study IDs which are unique by patient (not for the whole
         study).
         E.g.: LREN data. In such a case, you have to enable this flag. This will use PatientID + StudyID as a session
@@ -60,6 +85,48 @@ def visit(folder, provenance_id, step_name, previous_step_id=None, config=None,
     :param db_url: (optional) Database URL. If not defined, it looks for an Airflow configuration file.
     :param is_organised: (optional) Disable this flag when scanning a folder that has not been organised yet
     (should only affect nifti files).
+    :param workers: (optional) Number of worker processes used to detect the files types, hash the files and parse the
+    DICOM headers. The database is still written by a single writer, in the order the files are found. By default, the
+    files are processed sequentially.
+    :param executor: (optional) A concurrent.futures executor (e.g. a ThreadPoolExecutor) to use instead of the process
+    pool created from the workers parameter. It is not shut down by this function.
+    :param batch_size: (optional) Number of files recorded in the database at once. Changes are committed after
+    each batch.
+    :param fingerprint_index: (optional) Path of a local index file where the size, modification time and inode of the
+    recorded files are stored. When defined, files that did not change since the last visit of the same processing step
+    are skipped without being opened, and files that were deleted since are removed from the database. The shards of a
+    processing step can share a same index.
+    :param include: (optional) List of shell-style patterns (e.g. '*.dcm'). Only the files whose name matches one of
+    them are visited.
+    :param exclude: (optional) List of shell-style patterns. Files and folders whose name matches one of them are
+    skipped.
+    :param max_depth: (optional) Maximum depth of the visited sub-folders (0 means only the given folder).
+    :param stage_workers: (optional) Dictionary giving a number of threads to some of the 'sniff' (type detection),
+    'hash' (partial hash) and 'parse' (DICOM header) stages, e.g. {'hash': 4, 'parse': 8}. When defined, the files go
+    through a pipeline of threads connected by bounded queues (the workers and executor parameters are then ignored).
+    The other stages get one thread. The database is still written by a single writer, in the order the files are
+    found.
+    :param pipeline_stats: (optional) Dictionary filled with the statistics of each stage of the pipeline (processed
+    files, throughput, busy time, queue depth), indexed by stage name. It is updated while the visit runs.
+    :param shard: (optional) A tuple (index, count). Only the files of this shard of the folder are recorded. Several
+    workers can thus record a same folder into a same processing step (create it first with create_step), each one
+    visiting its own shard. Call finalize_step once all of them are done.
+    :param shard_by: (optional) 'folder' to split the folder by its sub-folders (e.g. participant folders) or 'file'
+    to split it by file. Default is 'folder'.
+    :param checkpoint: (optional) Path of a local checkpoint file. When defined, the changes are committed and the
+    last completed folder is stored in this file every checkpoint_interval files (or a bit more, to complete the
+    current folder). It is removed once the visit is complete. Each shard needs its own checkpoint file.
+    :param resume: (optional) Enable this flag to resume an interrupted visit from its checkpoint: the folders that
+    were completed are skipped. Deleted files are not removed from the database (see fingerprint_index) when
+    resuming.
+    :param checkpoint_interval: (optional) Minimum number of files recorded between two checkpoints.
+    :param nifti_layout: (optional) Folders layout the meta-data of the NIFTI files are extracted from: 'LREN'
+    (participant/visit/sequence/repetition/file), 'PPMI' (participant/sequence/visit/repetition/file) or 'BIDS'.
+    Default is 'LREN'.
+    :param recycle_interval: (optional) Number of files recorded before the database session is replaced by a new one
+    (it is also emptied after each batch). None disables it.
+    :param low_memory: (optional) Enable this flag to keep the memory usage low on very large folders, at the expense
+    of speed: smaller batches and caches, more frequent session recycling and less files inspected in advance.
     :return: return processing step ID.
     """
     config = config if config else []
@@ -67,58 +134,38 @@ def visit(folder, provenance_id, step_name, previous_step_id=None, config=None,
     logging.info("Visiting %s", folder)
     logging.info("-> is_organised=%s", str(is_organised))
     logging.info("-> config=%s", str(config))
+    logging.info("-> workers=%s", str(workers))
+
+    recorder = FileRecorder(provenance_id, step_name, previous_step_id, config, db_url, is_organised, batch_size,
+                            fingerprint_index, checkpoint, resume, checkpoint_interval, nifti_layout,
+                            recycle_interval, low_memory)
+
+    if stage_workers is not None:
+        stages = pipeline.Pipeline([(name, fn, stage_workers.get(name)) for name, fn in PIPELINE_STAGES],
+                                   stats=pipeline_stats)
+        files = recorder.list_files(folder, include, exclude, max_depth, shard, shard_by)
+        for inspected in stages.run(records.FileRecord(*args) for args in files):
+            recorder.record(inspected)
+        logging.info("Pipeline statistics: %s", stages.stats)
+        recorder.close()
+        return recorder.step_id
+
+    own_executor = None
+    if not executor and workers and workers > 1:
+        own_executor = futures.ProcessPoolExecutor(max_workers=workers)
+        executor = own_executor
+    try:
+        window = (1 if low_memory else PREFETCH_FACTOR) * (workers if workers else os.cpu_count() or 1)
+        files = recorder.list_files(folder, include, exclude, max_depth, shard, shard_by)
+        for inspected in _ordered_map(executor, inspect_file, files, window):
+            recorder.record(inspected)
+    finally:
+        if own_executor:
+            own_executor.shutdown()
 
-    logging.info("Connecting to database...")
-    db_conn = connection.Connection(db_url)
-
-    step_id = _create_step(db_conn, step_name, provenance_id, previous_step_id)
-
-    previous_files_hash = _get_files_hash_from_step(db_conn, previous_step_id)
-
-    checked = dict()
-
-    def process_file(file_path):
-        logging.debug("Processing '%s'" % file_path)
-        file_type = _find_type(file_path)
-        if "DICOM" == file_type:
-            is_copy = _hash_file(file_path) in previous_files_hash
-            leaf_folder = os.path.split(file_path)[0]
-            if leaf_folder not in checked or 'boost' not in config:
-                ret = dicom_import.dicom2db(file_path, file_type, is_copy, step_id, db_conn,
-                                            'session_id_by_patient' in config, 'visit_id_in_patient_id' in config,
-                                            'visit_id_in_patient_id' in config, 'repetition_from_path' in config)
-                try:
-                    checked[leaf_folder] = ret['repetition_id']
-                except KeyError:
-                    # TODO: Remove it when dicom2db will be more stable
-                    logging.warning("Cannot find repetition ID !")
-            else:
-                dicom_import.extract_dicom(
-                    file_path, file_type, is_copy, checked[leaf_folder], step_id)
-        elif "NIFTI" == file_type and is_organised:
-            is_copy = _hash_file(file_path) in previous_files_hash
-            nifti_import.nifti2db(file_path, file_type, is_copy, step_id, db_conn, 'session_id_by_patient' in config,
-                                  'visit_id_in_patient_id' in config)
-        elif file_type:
-            is_copy = _hash_file(file_path) in previous_files_hash
-            others_import.others2db(
-                file_path, file_type, is_copy, step_id, db_conn)
-
-    if sys.version_info.major == 3 and sys.version_info.minor < 5:
-        matches = []
-        for root, dirnames, filenames in os.walk(folder):
-            for filename in fnmatch.filter(filenames, '*'):
-                matches.append(os.path.join(root, filename))
-        for file_path in matches:
-            process_file(file_path)
-    else:
-        for file_path in glob.iglob(os.path.join(folder, "**/*"), recursive=True):
-            process_file(file_path)
-
-    logging.info("Closing database connection...")
-    db_conn.close()
+    recorder.close()
 
-    return step_id
+    return recorder.step_id
 
 
 def create_provenance(dataset, software_versions=None, db_url=None):
@@ -191,10 +238,290 @@ def create_provenance(dataset, software_versions=None, db_url=None):
     return provenance_id
 
 
+def create_step(provenance_id, step_name, previous_step_id=None, db_url=None):
+    """Create (or get if already exists) a processing step and get back its ID.
+
+    Note:
+    visit does it too. Call this before starting several visits of a same processing step in parallel (see the shard
+    parameter of visit), so that they do not race to create it.
+
+    Arguments:
+    :param provenance_id: provenance label.
+    :param step_name: Name of the processing step.
+    :param previous_step_id: (optional) previous processing step ID.
+    :param db_url: (optional) Database URL. If not defined, it looks for an Airflow configuration file.
+    :return: Processing step ID.
+    """
+    db_conn = connection.Connection(db_url)
+    step_id = _create_step(db_conn, step_name, provenance_id, previous_step_id)
+    db_conn.close()
+    return step_id
+
+
+def finalize_step(step_id, db_url=None):
+    """Finish a processing step recorded by several visits running in parallel (see the shard parameter of visit).
+
+    Note:
+    When the catalog does not have unique constraints on the participants and visits mappings, sessions, sequences and
+    repetitions, visits running in parallel can create the same one twice. Such duplicates are merged here. This only
+    reads the catalog when there is none.
+
+    Arguments:
+    :param step_id: Processing step ID.
+    :param db_url: (optional) Database URL. If not defined, it looks for an Airflow configuration file.
+    :return: Number of files recorded for this step.
+    """
+    db_conn = connection.Connection(db_url)
+    _merge_mappings(db_conn, db_conn.ParticipantMapping, 'participant_id', db_conn.Participant, db_conn.Visit)
+    _merge_mappings(db_conn, db_conn.VisitMapping, 'visit_id', db_conn.Visit, db_conn.Session)
+    for model, key_columns, child_model, child_column in [
+        (db_conn.Session, ['visit_id', 'name'], db_conn.Sequence, 'session_id'),
+        (db_conn.Sequence, ['session_id', 'name'], db_conn.Repetition, 'sequence_id'),
+        (db_conn.Repetition, ['sequence_id', 'name'], db_conn.DataFile, 'repetition_id')
+    ]:
+        _merge_duplicates(db_conn, model, key_columns, child_model, child_column)
+
+    step = db_conn.db_session.query(db_conn.ProcessingStep).filter_by(id=step_id).one()
+    step.execution_date = datetime.datetime.now()
+    count = db_conn.db_session.query(db_conn.DataFile).filter_by(processing_step_id=step_id).count()
+    db_conn.close()
+    logging.info("Processing step %s has %s files" % (step_id, count))
+    return count
+
+
+def inspect_file(file_path, is_organised=True, candidates=None):
+    """Detect the type of a file, compute its partial hash, check if it is a copy and read its DICOM header. This does
+    not need any database connection, so it can safely be run in a worker process.
+
+    Arguments:
+    :param file_path: File path.
+    :param is_organised: (optional) Disable this flag if the file comes from a folder that has not been organised yet.
+    :param candidates: (optional) Files from the previous processing step this file could be a copy of (see
+    copy_detection.CopyDetector.get_candidates).
+    :return: A FileRecord to give to FileRecorder.record.
+    """
+    return _parse_stage(_hash_stage(_sniff_stage(records.FileRecord(file_path, is_organised, candidates))))
+
+
+##########################################################################
+# CLASSES
+##########################################################################
+
+class FileRecorder:
+    """Record the files of a processing step into the database, in the order they are given.
+
+    This holds the state of a visit (database connection, copy detection, DICOM series already recorded, ...). It is
+    not thread safe: it should always be used from the same thread.
+    """
+
+    def __init__(self, provenance_id, step_name, previous_step_id=None, config=None, db_url=None, is_organised=True,
+                 batch_size=DATA_FILE_BATCH_SIZE, fingerprint_index=None, checkpoint=None, resume=False,
+                 checkpoint_interval=CHECKPOINT_INTERVAL, nifti_layout=None, recycle_interval=SESSION_RECYCLE_INTERVAL,
+                 low_memory=False):
+        """
+        Arguments: see visit.
+        """
+        self.config = config if config else []
+        self.is_organised = is_organised
+        self.nifti_layout = path_layouts.get_layout(nifti_layout)
+        cache_size = connection.ID_CACHE_SIZE
+        if low_memory:
+            batch_size = min(batch_size, LOW_MEMORY_BATCH_SIZE)
+            cache_size = LOW_MEMORY_CACHE_SIZE
+            recycle_interval = min(recycle_interval or LOW_MEMORY_RECYCLE_INTERVAL, LOW_MEMORY_RECYCLE_INTERVAL)
+        self.batch_size = batch_size
+        self.recycle_interval = recycle_interval
+        self.last_recycle = 0
+
+        logging.info("Connecting to database...")
+        self.db_conn = connection.Connection(db_url, batch_size, cache_size)
+        self.step_id = _create_step(self.db_conn, step_name, provenance_id, previous_step_id)
+        self.previous_files = copy_detection.CopyDetector(self.db_conn, previous_step_id)
+
+        self.index = fingerprints.FingerprintIndex(fingerprint_index, self.step_id) if fingerprint_index else None
+        self.file_stats = dict()
+        self.checked = cache.LRUCache(cache_size)  # Repetition IDs of the DICOM series already recorded
+        self.series_files = []  # DICOM files of the current folder, not recorded yet
+        self.count = 0
+
+        self.checkpoint = checkpoints.Checkpoint(checkpoint, self.step_id) if checkpoint else None
+        self.checkpoint_interval = checkpoint_interval
+        self.start_after = self.checkpoint.load() if self.checkpoint and resume else None
+        if self.start_after is not None:
+            logging.info("Resuming after folder %s" % self.start_after)
+        self.folder = None
+        self.walk_filters = dict()
+        self.current_folder = None
+        self.last_checkpoint = 0
+
+    def list_files(self, folder, include=None, exclude=None, max_depth=None, shard=None, shard_by='folder'):
+        """List the files of a folder that need to be recorded (see walker.walk). Unchanged files are skipped.
+
+        :return: A generator of (file path, is_organised, candidates) tuples, the arguments of inspect_file.
+        """
+        self.folder = folder
+        self.walk_filters = dict(include=include, exclude=exclude, max_depth=max_depth, shard=shard, shard_by=shard_by)
+        for _, entries in walker.walk(folder, include, exclude, max_depth, shard=shard, shard_by=shard_by,
+                                      start_after=self.start_after):
+            for entry in entries:
+                file_path = entry.path
+                file_stat = None
+                if self.index or self.previous_files.by_size:
+                    try:
+                        file_stat = entry.stat()
+                    except OSError:
+                        if self.index:
+                            continue
+                if self.index:
+                    if self.index.is_unchanged(file_path, file_stat):
+                        logging.debug("Skipping unchanged file '%s'" % file_path)
+                        continue
+                    self.file_stats[file_path] = file_stat
+                candidates = self.previous_files.get_candidates(file_stat.st_size) if file_stat else None
+                yield file_path, self.is_organised, candidates
+
+    def record(self, record):
+        """Record an inspected file (a FileRecord, see inspect_file). Changes are committed after each batch of
+        files."""
+        folder = os.path.dirname(record.path)
+        if folder != self.current_folder:
+            # The files are recorded folder by folder: a folder is complete when the first file of another one comes
+            self._record_series()
+            if self.checkpoint:
+                self._check_folder()
+            self.current_folder = folder
+        if "DICOM" == record.file_type and record.header is not None:
+            # The DICOM files of a folder are recorded together, so that their sequence types are resolved at once
+            self.series_files.append(record)
+        else:
+            self._record_file(record)
+        self.count += 1
+        if 0 == self.count % self.batch_size:
+            self._record_series()
+            if self.recycle_interval and self.count - self.last_recycle >= self.recycle_interval:
+                # Also release what the session keeps between transactions (e.g. the state of its connection)
+                self.db_conn.recycle()
+                self.last_recycle = self.count
+            else:
+                self.db_conn.commit()
+            if self.index:
+                # Only persist the fingerprints once the files are committed in the database
+                self.index.commit()
+
+    def close(self):
+        """Remove the deleted files (when using a fingerprint index), commit the changes and close the connection."""
+        self._record_series()
+        if self.index and self.start_after is not None:
+            # The files of the folders skipped when resuming were not seen
+            logging.info("Deleted files are not removed from the database when resuming a visit")
+        elif self.index and self.folder is not None:
+            # Only the files of the walked tree could be seen (e.g. files filtered out or in another shard)
+            removed_files = [path for path in self.index.unseen()
+                             if walker.covers(self.folder, path, **self.walk_filters)]
+            logging.info("Removing %s deleted files from the database..." % len(removed_files))
+            _remove_files(self.db_conn, removed_files, self.step_id)
+            self.index.forget(removed_files)
+
+        logging.info("Closing database connection...")
+        self.db_conn.close()
+
+        if self.index:
+            # Only persist the fingerprints once the files are committed in the database
+            self.index.commit()
+            self.index.close()
+
+        if self.checkpoint:
+            self.checkpoint.clear()
+
+    def _check_folder(self):
+        if self.current_folder is not None and self.count - self.last_checkpoint >= self.checkpoint_interval:
+            self.db_conn.commit()
+            if self.index:
+                self.index.commit()
+            self.checkpoint.save(os.path.relpath(self.current_folder, self.folder), self.count)
+            self.last_checkpoint = self.count
+            logging.info("Checkpoint after %s files (%s)" % (self.count, self.current_folder))
+
+    def _record_series(self):
+        if not self.series_files:
+            return
+        series_files, self.series_files = self.series_files, []
+        # With boost, only the first file of each series needs its sequence type
+        resolved = []
+        series_seen = set()
+        for record in series_files:
+            series = _get_series(record)
+            if 'boost' not in self.config or (series not in self.checked and series not in series_seen):
+                resolved.append(record)
+                series_seen.add(series)
+        sequence_type_ids = []
+        if resolved:
+            try:
+                with self.db_conn.db_session.begin_nested():
+                    sequence_type_ids = dicom_import.get_sequence_type_ids([r.header for r in resolved], self.db_conn)
+            except IntegrityError:
+                # They are resolved file by file instead (see dicom_import.dicom2db)
+                logging.warning("Cannot resolve the sequence types of %s files at once" % len(resolved))
+                sequence_type_ids = [None] * len(resolved)
+        sequence_type_ids = {record.path: i for record, i in zip(resolved, sequence_type_ids)}
+        for record in series_files:
+            self._record_file(record, sequence_type_ids.get(record.path))
+
+    def _record_file(self, record, sequence_type_id=None):
+        is_recorded = self._process_file(record, sequence_type_id)
+        if record.path in self.file_stats:
+            file_stat = self.file_stats.pop(record.path)
+            if is_recorded:
+                self.index.record(record.path, file_stat)
+            else:
+                # Not recorded (e.g. unreadable DICOM header): it is processed again by the next visit
+                self.index.forget([record.path])
+
+    def _process_file(self, record, sequence_type_id=None):
+        # Return True if the file was recorded
+        file_path, file_type, dcm = record.path, record.file_type, record.header
+        logging.debug("Processing '%s'" % file_path)
+        config = self.config
+        is_copy, file_hash = record.is_copy, record.file_hash
+        if record.candidate_hashes:
+            self.previous_files.add_hashes(record.candidate_hashes)
+        if "DICOM" == file_type:
+            series = _get_series(record)
+            if series not in self.checked or 'boost' not in config:
+                ret = dicom_import.dicom2db(file_path, file_type, is_copy, self.step_id, self.db_conn,
+                                            'session_id_by_patient' in config, 'visit_id_in_patient_id' in config,
+                                            'visit_id_in_patient_id' in config, 'repetition_from_path' in config,
+                                            dcm=dcm, file_hash=file_hash, sequence_type_id=sequence_type_id)
+                try:
+                    self.checked.put(series, ret['repetition_id'])
+                except KeyError:
+                    # TODO: Remove it when dicom2db will be more stable
+                    logging.warning("Cannot find repetition ID !")
+                    return False
+            else:
+                dicom_import.extract_dicom(
+                    file_path, file_type, is_copy, self.checked.get(series), self.step_id, file_hash)
+        elif "NIFTI" == file_type and self.is_organised:
+            nifti_import.nifti2db(file_path, file_type, is_copy, self.step_id, self.db_conn,
+                                  'session_id_by_patient' in config, 'visit_id_in_patient_id' in config, file_hash,
+                                  self.nifti_layout)
+        elif file_type:
+            others_import.others2db(
+                file_path, file_type, is_copy, self.step_id, self.db_conn, file_hash)
+        else:
+            return False
+        return True
+
+
 ##########################################################################
 # PRIVATE FUNCTIONS
 ##########################################################################
 
+def _get_series(record):
+    # Files from a same folder and a same series share the same meta-data
+    return (os.path.dirname(record.path),) + dicom_import.get_series_uids(record.header)
+
+
 def _create_step(db_conn, name, provenance_id, previous_step_id=None):
     step = db_conn.db_session.query(db_conn.ProcessingStep).filter_by(
         name=name, provenance_id=provenance_id, previous_step_id=previous_step_id
@@ -217,8 +544,98 @@ def _create_step(db_conn, name, provenance_id, previous_step_id=None):
     return step.id
 
 
+def _remove_files(db_conn, paths, step_id):
+    for i in range(0, len(paths), DELETE_CHUNK_SIZE):
+        db_conn.db_session.query(db_conn.DataFile).filter(
+            db_conn.DataFile.processing_step_id == step_id,
+            db_conn.DataFile.path.in_(paths[i:i + DELETE_CHUNK_SIZE])
+        ).delete(synchronize_session=False)
+    db_conn.db_session.commit()
+
+
+def _merge_duplicates(db_conn, model, key_columns, child_model, child_column):
+    table = model.__table__
+    if db_conn.has_unique_key(table, *key_columns):
+        return
+    keys = [table.c[column] for column in key_columns]
+    duplicates = db_conn.db_session.execute(sql.select(keys + [sql_func.min(table.c.id)]).group_by(*keys).having(
+        sql_func.count(table.c.id) > 1)).fetchall()
+    child_table = child_model.__table__
+    for row in duplicates:
+        kept_id = row[-1]
+        criteria = [key == value for key, value in zip(keys, row[:-1])]
+        ids = [r[0] for r in db_conn.db_session.execute(
+            sql.select([table.c.id]).where(sql.and_(table.c.id != kept_id, *criteria)))]
+        logging.info("Merging %s duplicates of %s %s" % (len(ids), table.name, kept_id))
+        db_conn.db_session.execute(
+            child_table.update().where(child_table.c[child_column].in_(ids)).values({child_column: kept_id}))
+        db_conn.db_session.execute(table.delete().where(table.c.id.in_(ids)))
+    db_conn.db_session.commit()
+
+
+def _merge_mappings(db_conn, mapping_model, id_column, model, child_model):
+    # A participant (or visit) name mapped twice got two IDs: the smallest one is kept
+    table = mapping_model.__table__
+    if db_conn.has_unique_key(table, 'dataset', 'name'):
+        return
+    keys = [table.c.dataset, table.c.name]
+    duplicates = db_conn.db_session.execute(sql.select(keys + [sql_func.min(table.c[id_column])]).group_by(
+        *keys).having(sql_func.count(table.c.id) > 1)).fetchall()
+    model_table = model.__table__
+    child_table = child_model.__table__
+    for dataset, name, kept_id in duplicates:
+        criteria = sql.and_(table.c.dataset == dataset, table.c.name == name)
+        ids = [r[0] for r in db_conn.db_session.execute(
+            sql.select([table.c[id_column]]).where(sql.and_(table.c[id_column] != kept_id, criteria)).distinct())]
+        logging.info("Merging %s duplicates of %s %s" % (len(ids), model_table.name, kept_id))
+        db_conn.db_session.execute(
+            child_table.update().where(child_table.c[id_column].in_(ids)).values({id_column: kept_id}))
+        db_conn.db_session.execute(model_table.delete().where(model_table.c.id.in_(ids)))
+        kept_row = db_conn.db_session.execute(sql.select([sql_func.min(table.c.id)]).where(criteria)).scalar()
+        db_conn.db_session.execute(table.delete().where(sql.and_(criteria, table.c.id != kept_row)))
+    db_conn.db_session.commit()
+
+
+def _ordered_map(executor, fn, iterable, window):
+    if not executor:
+        for args in iterable:
+            yield fn(*args)
+        return
+    pending = collections.deque()
+    for args in iterable:
+        pending.append(executor.submit(fn, *args))
+        if len(pending) >= window:
+            yield pending.popleft().result()
+    while pending:
+        yield pending.popleft().result()
+
+
+def _sniff_stage(record):
+    record.file_type = _find_type(record.path)
+    return record
+
+
+def _hash_stage(record):
+    if record.file_type and ("NIFTI" != record.file_type or record.is_organised):
+        record.size, record.edges = copy_detection.hash_edges(record.path)
+        if record.candidates:
+            # Only the files having the size of a file from the previous step are read in full
+            record.is_copy, record.file_hash, record.candidate_hashes = copy_detection.find_copy(
+                record.path, record.edges, record.candidates)
+    return record
+
+
+def _parse_stage(record):
+    if "DICOM" == record.file_type:
+        record.header = dicom_import.read_header(record.path)
+    return record
+
+
 def _find_type(file_path):
     try:
+        file_type = _sniff_type(file_path)
+        if file_type:
+            return file_type
         file_type = magic.from_file(file_path)
         if "DICOM medical imaging data" == file_type:
             return "DICOM"
@@ -238,20 +655,30 @@ def _find_type(file_path):
     return "other"
 
 
-def _get_files_hash_from_step(db_conn, step_id):
-    files = db_conn.db_session.query(db_conn.DataFile).filter_by(
-        processing_step_id=step_id).all()
-    return [_hash_file(file.path) for file in files]
+def _sniff_type(file_path):
+    # Recognize DICOM and NIFTI files from their first bytes, without libmagic nor a full parsing
+    with open(file_path, 'rb') as f:
+        head = f.read(SNIFF_SIZE)
+    if head[:2] == b'\x1f\x8b' and file_path.endswith('.gz'):
+        try:
+            with gzip.open(file_path, 'rb') as f:
+                head = f.read(SNIFF_SIZE)
+        except (OSError, EOFError):
+            return None
+    if head[128:132] == b'DICM':
+        return "DICOM"
+    if len(head) >= 348:
+        # sizeof_hdr can be stored in little or big endian
+        header_sizes = struct.unpack('<i', head[:4]) + struct.unpack('>i', head[:4])
+        if 348 in header_sizes and head[344:348] in (b'n+1\x00', b'ni1\x00'):
+            return "NIFTI"
+        if 540 in header_sizes and head[4:8] in (b'n+2\x00', b'ni2\x00'):
+            return "NIFTI"
+    return None
 
 
-def _hash_file(filename):
-    hasher = hashlib.sha1()
-    try:
-        with open(filename, 'rb') as f:
-            buf = f.read(HASH_BLOCK_SIZE)
-            while len(buf) > 0:
-                hasher.update(buf)
-                buf = f.read(HASH_BLOCK_SIZE)
-        return hasher.hexdigest()
-    except OSError:
-        return None
+##########################################################################
+# GLOBAL VARIABLES
+##########################################################################
+
+PIPELINE_STAGES = [('sniff', _sniff_stage), ('hash', _hash_stage), ('parse', _parse_stage)]
@@ -0,0 +1,128 @@
+import collections
+import sqlite3
+import threading
+import uuid
+
+
+#######################################################################################################################
+# SETTINGS
+#######################################################################################################################
+
+LOCK_TIMEOUT = 60  # Number of seconds to wait for another visit writing to the same index
+SEEN_BATCH_SIZE = 1000  # Number of files marked as seen at once
+
+
+#######################################################################################################################
+# CLASSES
+#######################################################################################################################
+
+class FingerprintIndex:
+    """Local index of the (size, modification time, inode) fingerprints of the files recorded for a processing step.
+
+    The index is a SQLite file (it does not need to be on the same host as the catalog). A file whose fingerprint did
+    not change since it was recorded does not need to be opened again. It can be used from several threads (e.g. one
+    listing the files and another one recording them).
+
+    Several visits can share an index (e.g. the shards of a same processing step): the changes are buffered and
+    written in short transactions, and the files are marked as seen by the visit which saw them.
+    """
+
+    def __init__(self, index_path, step_id):
+        """
+        Arguments:
+        :param index_path: Path of the index file. It is created if it does not exist.
+        :param step_id: Processing step ID.
+        """
+        self.step_id = step_id
+        self.visit_id = uuid.uuid4().hex  # Marks the files seen by this visit
+        self.db = sqlite3.connect(index_path, timeout=LOCK_TIMEOUT, isolation_level=None, check_same_thread=False)
+        self.lock = threading.Lock()
+        self.seen = []
+        self.pending = collections.OrderedDict()  # Fingerprints to store (or None to remove them), indexed by path
+        # Let the other visits read the index while one of them writes to it
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS fingerprint ("
+            "step_id INTEGER, path TEXT, size INTEGER, mtime_ns INTEGER, inode INTEGER, seen INTEGER, "
+            "PRIMARY KEY (step_id, path))")
+
+    def is_unchanged(self, path, stat):
+        """Check if a file did not change since it was recorded. The file is then marked as seen.
+
+        Arguments:
+        :param path: File path.
+        :param stat: Result of os.stat on this file.
+        :return: True if the file is already recorded with the same fingerprint.
+        """
+        with self.lock:
+            row = self.db.execute(
+                "SELECT 1 FROM fingerprint WHERE step_id = ? AND path = ? AND size = ? AND mtime_ns = ? AND inode = ?",
+                (self.step_id, path, stat.st_size, stat.st_mtime_ns, stat.st_ino)).fetchone()
+            if row is None:
+                return False
+            self.seen.append(path)
+            if len(self.seen) >= SEEN_BATCH_SIZE:
+                self._write()
+            return True
+
+    def record(self, path, stat):
+        """Store (or update) the fingerprint of a file which has just been recorded. It is written by the next commit.
+
+        Arguments:
+        :param path: File path.
+        :param stat: Result of os.stat on this file, taken before it was processed.
+        """
+        with self.lock:
+            self.pending[path] = (stat.st_size, stat.st_mtime_ns, stat.st_ino)
+
+    def unseen(self):
+        """List the files which are indexed but were not seen by this visit (e.g. deleted files).
+
+        :return: List of paths.
+        """
+        with self.lock:
+            self._write()
+            return [row[0] for row in self.db.execute(
+                "SELECT path FROM fingerprint WHERE step_id = ? AND (seen IS NULL OR seen != ?)",
+                (self.step_id, self.visit_id)) if row[0] not in self.pending]
+
+    def forget(self, paths):
+        """Remove some files from the index. They are removed by the next commit.
+
+        Arguments:
+        :param paths: List of paths.
+        """
+        with self.lock:
+            for path in paths:
+                self.pending[path] = None
+
+    def commit(self):
+        """Persist the changes. This should be done once the recorded files are committed in the catalog."""
+        with self.lock:
+            pending, self.pending = self.pending, collections.OrderedDict()
+            self._write(pending)
+
+    def close(self):
+        with self.lock:
+            self.db.close()
+
+    def _write(self, pending=None):
+        # Each write is a short transaction, so that the other visits sharing the index are not blocked
+        if not self.seen and not pending:
+            return
+        self.db.execute("BEGIN IMMEDIATE")
+        try:
+            self.db.executemany("UPDATE fingerprint SET seen = ? WHERE step_id = ? AND path = ?",
+                                [(self.visit_id, self.step_id, path) for path in self.seen])
+            for path, fingerprint in (pending or dict()).items():
+                if fingerprint is None:
+                    self.db.execute("DELETE FROM fingerprint WHERE step_id = ? AND path = ?", (self.step_id, path))
+                else:
+                    self.db.execute(
+                        "INSERT OR REPLACE INTO fingerprint (step_id, path, size, mtime_ns, inode, seen) "
+                        "VALUES (?, ?, ?, ?, ?, ?)", (self.step_id, path) + fingerprint + (self.visit_id,))
+            self.db.execute("COMMIT")
+        except BaseException:
+            self.db.execute("ROLLBACK")
+            raise
+        self.seen = []
@@ -0,0 +1,126 @@
+import os
+import re
+import threading
+
+from . import cache
+
+
+#######################################################################################################################
+# SETTINGS
+#######################################################################################################################
+
+DIRECTORY_CACHE_SIZE = 10000  # Maximum number of parsed directories kept in memory by each layout
+
+
+#######################################################################################################################
+# PUBLIC FUNCTIONS
+#######################################################################################################################
+
+def get_layout(layout=None):
+    """Get a path layout.
+
+    Arguments:
+    :param layout: (optional) Name of one of the LAYOUTS (e.g. 'BIDS') or a PathLayout. Default is 'LREN'.
+    :return: A PathLayout.
+    """
+    if isinstance(layout, PathLayout):
+        return layout
+    try:
+        return LAYOUTS[(layout or 'LREN').upper()]
+    except KeyError:
+        raise ValueError("Unknown path layout: %s" % layout)
+
+
+#######################################################################################################################
+# CLASSES
+#######################################################################################################################
+
+class PathLayout:
+    """Extract the participant, visit, session, sequence and repetition names from the path of a file.
+
+    The names are given by the last folders of the path and, for some layouts, by the file name. The folders are
+    parsed once per directory: all the files of a directory share the same parsed fields.
+    """
+
+    def __init__(self, name, folder_pattern, file_pattern=None, aliases=None, defaults=None):
+        """
+        Arguments:
+        :param name: Layout name.
+        :param folder_pattern: Regular expression matching the end of the folder path of a file. Its named groups give
+        the fields.
+        :param file_pattern: (optional) Regular expression matching the file name. Its named groups give the fields
+        that depend on the file (e.g. the BIDS run).
+        :param aliases: (optional) Dictionary of fields copied from another field when they are not found (e.g.
+        {'session': 'visit'}). They are applied in order.
+        :param defaults: (optional) Dictionary of the default values of the fields that are not found.
+        """
+        self.name = name
+        self.folder_regex = re.compile(folder_pattern)
+        self.file_regex = re.compile(file_pattern) if file_pattern else None
+        self.aliases = aliases or dict()
+        self.defaults = defaults or dict()
+        self.directories = cache.LRUCache(DIRECTORY_CACHE_SIZE)
+        self.lock = threading.Lock()  # The layouts are shared by all the threads
+
+    def parse(self, file_path):
+        """Parse the path of a file.
+
+        Arguments:
+        :param file_path: File path.
+        :return: A dictionary with the 'participant', 'visit', 'session', 'sequence' and 'repetition' fields, or None
+        if the path does not match this layout.
+        """
+        directory, file_name = os.path.split(file_path)
+        fields = self.parse_directory(directory)
+        if fields is None or not self.file_regex:
+            return fields
+        match = self.file_regex.search(file_name)
+        if not match:
+            return None
+        fields = dict(fields)
+        fields.update((k, v) for k, v in match.groupdict().items() if v is not None)
+        return fields
+
+    def parse_directory(self, directory):
+        """Parse the folder path of a file (memoised).
+
+        :return: A dictionary of the fields given by the folders, or None if the path does not match this layout.
+        """
+        with self.lock:
+            fields = self.directories.get(directory, _MISSING)
+        if fields is not _MISSING:
+            return fields
+        match = self.folder_regex.search(directory.replace(os.sep, '/'))
+        fields = None
+        if match:
+            fields = dict(self.defaults)
+            fields.update((k, v) for k, v in match.groupdict().items() if v is not None)
+            for field, source in self.aliases.items():
+                fields.setdefault(field, fields.get(source))
+        with self.lock:
+            self.directories.put(directory, fields)
+        return fields
+
+
+#######################################################################################################################
+# GLOBAL VARIABLES
+#######################################################################################################################
+
+_MISSING = object()  # Marks the directories which were not parsed yet
+
+LAYOUTS = {
+    # participant/visit/sequence/repetition/file.nii, the visit is also the session
+    'LREN': PathLayout(
+        'LREN', r'(?:^|/)(?P<participant>[^/]+)/(?P<visit>[^/]+)/(?P<sequence>[^/]+)/(?P<repetition>[^/]+)$',
+        file_pattern=r'\.nii', aliases={'session': 'visit'}),
+    # PATNO/description/acquisition date/image ID/file.nii, the acquisition date is the visit and the session
+    'PPMI': PathLayout(
+        'PPMI', r'(?:^|/)(?P<participant>[^/]+)/(?P<sequence>[^/]+)/(?P<visit>[^/]+)/(?P<repetition>[^/]+)$',
+        file_pattern=r'\.nii', aliases={'session': 'visit'}),
+    # sub-<label>/[ses-<label>/]<datatype>/sub-<label>_[...][_run-<index>]_<suffix>.nii[.gz], the suffix (e.g. T1w) is
+    # the sequence and the run is the repetition. Without sessions, each participant has a single visit named after it.
+    'BIDS': PathLayout(
+        'BIDS', r'(?:^|/)sub-(?P<participant>[^/]+)(?:/ses-(?P<visit>[^/]+))?/[^/]+$',
+        file_pattern=r'^sub-[^_]+(?=(?:.*_run-(?P<repetition>[^_.]+))?).*_(?P<sequence>[^_.]+)\.nii',
+        aliases={'visit': 'participant', 'session': 'visit'}, defaults={'repetition': '1'}),
+}
@@ -0,0 +1,190 @@
+import logging
+import queue
+import threading
+import time
+
+
+##########################################################################
+# SETTINGS
+##########################################################################
+
+QUEUE_SIZE = 256  # Maximum number of items waiting between two stages
+POLL_INTERVAL = 0.1  # Number of seconds between two checks of the stop flag by a blocked thread
+
+
+##########################################################################
+# CLASSES
+##########################################################################
+
+class Pipeline:
+    """Run items through a sequence of stages connected by bounded queues.
+
+    The items are read from the source by a dedicated thread and each stage has its own pool of threads, so a slow
+    stage can be given more threads than the others. When a stage falls behind, the queue before it fills up and the
+    previous stages are paused. The results are given back in the order of the source. The number of items in flight
+    (including the results waiting for a previous item) is bounded, so the source is also paused when an item is
+    slow.
+
+    Statistics are kept while the pipeline runs for the source, for each stage and for the output (the results waiting
+    to be consumed).
+    """
+
+    def __init__(self, stages, queue_size=QUEUE_SIZE, stats=None):
+        """
+        Arguments:
+        :param stages: List of (name, function, number of threads) tuples. A function is called with an item and
+        returns the item given to the next stage.
+        :param queue_size: (optional) Maximum number of items waiting between two stages.
+        :param stats: (optional) Dictionary to fill with the statistics, indexed by stage name. It is updated while
+        the pipeline runs.
+        """
+        self.stages = [(name, fn, max(workers or 1, 1)) for name, fn, workers in stages]
+        self.queue_size = max(queue_size, 1)
+        self.stats = stats if stats is not None else dict()
+        self.stats_lock = threading.Lock()
+
+    def run(self, source):
+        """Run the items of an iterable through the pipeline.
+
+        Arguments:
+        :param source: Iterable of items.
+        :return: A generator of the results of the last stage, in the order of the source. If a stage fails on an item,
+        the exception is raised when this item is reached.
+        """
+        queues = [queue.Queue(self.queue_size) for _ in range(len(self.stages) + 1)]
+        stop = threading.Event()
+        start = time.time()
+        self.stats.clear()
+        names = ['source'] + [stage[0] for stage in self.stages] + ['output']
+        self.stats.update((name, _new_stats()) for name in names)
+        # As many items as the queues and the threads can hold
+        in_flight = threading.BoundedSemaphore(self.queue_size * len(queues) + sum(stage[2] for stage in self.stages))
+
+        threads = [threading.Thread(target=self._feed, args=(source, queues[0], stop, start, in_flight))]
+        for i, (name, fn, workers) in enumerate(self.stages):
+            remaining = [workers]
+            for _ in range(workers):
+                threads.append(threading.Thread(
+                    target=self._work, args=(name, fn, queues[i], queues[i + 1], stop, start, remaining)))
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+
+        try:
+            pending = dict()
+            next_seq = 0
+            while True:
+                item = _get(queues[-1], stop)
+                if item is _END:
+                    break
+                pending[item[0]] = item[1]
+                self._update('output', start, queues[-1])
+                while next_seq in pending:
+                    result = pending.pop(next_seq)
+                    in_flight.release()
+                    next_seq += 1
+                    if isinstance(result, _Failure):
+                        raise result.error
+                    yield result
+        finally:
+            stop.set()
+            for thread in threads:
+                thread.join()
+
+    def _feed(self, source, out_queue, stop, start, in_flight):
+        seq = 0
+        try:
+            for item in source:
+                if not _acquire(in_flight, stop) or not _put(out_queue, (seq, item), stop):
+                    return
+                seq += 1
+                self._update('source', start)
+        except Exception as e:
+            if _acquire(in_flight, stop):
+                _put(out_queue, (seq, _Failure(e)), stop)
+        _put(out_queue, _END, stop)
+
+    def _work(self, name, fn, in_queue, out_queue, stop, start, remaining):
+        while True:
+            item = _get(in_queue, stop)
+            if item is None:
+                return
+            if item is _END:
+                # Let the other threads of this stage stop too, the last one tells the next stage
+                with self.stats_lock:
+                    remaining[0] -= 1
+                    last = 0 == remaining[0]
+                _put(out_queue if last else in_queue, _END, stop)
+                return
+            seq, value = item
+            busy = time.time()
+            if not isinstance(value, _Failure):
+                try:
+                    value = fn(value)
+                except Exception as e:
+                    logging.debug("Stage %s failed on item %s" % (name, seq))
+                    value = _Failure(e)
+            busy = time.time() - busy
+            if not _put(out_queue, (seq, value), stop):
+                return
+            self._update(name, start, in_queue, busy)
+
+    def _update(self, name, start, in_queue=None, busy=0.0):
+        with self.stats_lock:
+            stats = self.stats[name]
+            stats['processed'] += 1
+            stats['busy_time'] += busy
+            elapsed = time.time() - start
+            stats['throughput'] = stats['processed'] / elapsed if elapsed > 0 else 0.0
+            if in_queue is not None:
+                stats['queue_depth'] = in_queue.qsize()
+                stats['max_queue_depth'] = max(stats['max_queue_depth'], stats['queue_depth'])
+
+
+class _Failure:
+
+    def __init__(self, error):
+        self.error = error
+
+
+##########################################################################
+# PRIVATE FUNCTIONS
+##########################################################################
+
+def _new_stats():
+    # throughput is in items per second since the pipeline started, busy_time is summed over the threads of the stage,
+    # queue_depth is the number of items waiting for the stage
+    return {'processed': 0, 'busy_time': 0.0, 'throughput': 0.0, 'queue_depth': 0, 'max_queue_depth': 0}
+
+
+def _put(out_queue, item, stop):
+    while not stop.is_set():
+        try:
+            out_queue.put(item, timeout=POLL_INTERVAL)
+            return True
+        except queue.Full:
+            continue
+    return False
+
+
+def _acquire(semaphore, stop):
+    while not stop.is_set():
+        if semaphore.acquire(timeout=POLL_INTERVAL):
+            return True
+    return False
+
+
+def _get(in_queue, stop):
+    while not stop.is_set():
+        try:
+            return in_queue.get(timeout=POLL_INTERVAL)
+        except queue.Empty:
+            continue
+    return None
+
+
+##########################################################################
+# GLOBAL VARIABLES
+##########################################################################
+
+_END = object()  # Marks the end of the source
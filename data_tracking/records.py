@@ -0,0 +1,63 @@
+"""Compact records holding the meta-data of the files being recorded.
+
+They use __slots__ (or are named tuples), so they do not have a per-instance dictionary and can cheaply be sent to
+worker processes.
+"""
+
+import collections
+
+
+#######################################################################################################################
+# CLASSES
+#######################################################################################################################
+
+class FileRecord:
+    """A file being recorded, filled in by the inspection stages (see files_recording.inspect_file)."""
+
+    __slots__ = ('path', 'is_organised', 'candidates', 'file_type', 'size', 'edges', 'is_copy', 'file_hash',
+                 'candidate_hashes', 'header')
+
+    def __init__(self, path, is_organised=True, candidates=None):
+        self.path = path
+        self.is_organised = is_organised
+        self.candidates = candidates  # Files from the previous step it could be a copy of (see copy_detection)
+        self.file_type = None  # 'DICOM', 'NIFTI', 'other' or None for files that cannot be recorded
+        self.size = None
+        self.edges = None  # Partial hash (see copy_detection.hash_edges)
+        self.is_copy = False
+        self.file_hash = None  # Full hash, only computed when the file could be a copy
+        self.candidate_hashes = None  # Full hashes computed for the candidates (see copy_detection.find_copy)
+        self.header = None  # SeriesHeader of a DICOM file
+
+
+class SeriesHeader:
+    """Values of the DICOM header tags read by dicom_import.read_header (see dicom_import.HEADER_TAGS).
+
+    The values are plain Python values (str, int, float or lists of them). Like with a pydicom data set, reading a tag
+    which was not found in the file raises an AttributeError.
+    """
+
+    __slots__ = (
+        'SeriesDate', 'AcquisitionDate', 'Manufacturer', 'InstitutionName', 'SeriesDescription',
+        'ManufacturerModelName', 'PatientID', 'PatientBirthDate', 'PatientSex', 'PatientAge', 'SliceThickness',
+        'RepetitionTime', 'EchoTime', 'EchoNumbers', 'MagneticFieldStrength', 'SpacingBetweenSlices',
+        'NumberOfPhaseEncodingSteps', 'EchoTrainLength', 'PercentSampling', 'PercentPhaseFieldOfView',
+        'PixelBandwidth', 'ProtocolName', 'FlipAngle', 'StudyInstanceUID', 'SeriesInstanceUID', 'StudyID',
+        'SeriesNumber', 'Rows', 'Columns', 'PixelSpacing'
+    )
+
+    def __getstate__(self):
+        return {name: getattr(self, name) for name in self.__slots__ if hasattr(self, name)}
+
+    def __setstate__(self, state):
+        for name, value in state.items():
+            setattr(self, name, value)
+
+
+# Normalised values of the columns identifying a sequence type (see connection.sequence_type_fingerprint)
+SequenceTypeKey = collections.namedtuple('SequenceTypeKey', [
+    'name', 'manufacturer', 'manufacturer_model_name', 'institution_name', 'slice_thickness', 'repetition_time',
+    'echo_time', 'echo_number', 'number_of_phase_encoding_steps', 'percent_phase_field_of_view', 'pixel_bandwidth',
+    'flip_angle', 'rows', 'columns', 'magnetic_field_strength', 'space_between_slices', 'echo_train_length',
+    'percent_sampling', 'pixel_spacing_0', 'pixel_spacing_1'
+])
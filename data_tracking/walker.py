@@ -0,0 +1,132 @@
+import fnmatch
+import logging
+import os
+import zlib
+
+try:
+    from os import scandir
+except ImportError:
+    from scandir import scandir  # Backport for Python 3.4
+
+
+#######################################################################################################################
+# PUBLIC FUNCTIONS
+#######################################################################################################################
+
+def walk(folder, include=None, exclude=None, max_depth=None, include_hidden=False, shard=None, shard_by='folder',
+         start_after=None):
+    """Walk through a folder tree and list its files, folder by folder.
+
+    Folders are visited depth-first, in alphabetical order, and the files of a folder are listed before its
+    sub-folders are visited. The walk order is thus deterministic. Only one folder is listed at a time, so the memory
+    usage does not depend on the size of the tree.
+
+    Arguments:
+    :param folder: Root folder path.
+    :param include: (optional) List of shell-style patterns (e.g. '*.dcm'). Only the files whose name matches one of
+    them are listed.
+    :param exclude: (optional) List of shell-style patterns. Files and folders whose name matches one of them are
+    skipped.
+    :param max_depth: (optional) Maximum depth of the visited folders (0 means only the root folder).
+    :param include_hidden: (optional) Enable this flag to list hidden files and folders (whose name starts with a dot).
+    :param shard: (optional) A tuple (index, count). Only the files of this shard (out of count shards) are listed.
+    Shards are deterministic and do not overlap, so several processes can each list their own shard of a same folder.
+    :param shard_by: (optional) 'folder' to assign each entry of the root folder (e.g. a participant folder) with all
+    its content to a shard, or 'file' to assign each file to a shard. Default is 'folder'.
+    :param start_after: (optional) Path of a folder, relative to the root folder. The walk starts right after this
+    folder: the folders listed before it (and itself) are skipped, without being listed again.
+    :return: A generator of (folder path, list of os.DirEntry of its regular files) tuples. Folders without any file
+    are not yielded.
+    """
+    if shard_by not in ('folder', 'file'):
+        raise ValueError("Unknown shard_by value: %s" % shard_by)
+    if shard and not 0 <= shard[0] < shard[1]:
+        raise ValueError("Invalid shard: %s" % str(shard))
+
+    start_after = _split(start_after) if start_after is not None else None
+
+    stack = [(folder, 0)]
+    while stack:
+        path, depth = stack.pop()
+        skip_files = False
+        if start_after is not None:
+            # The walk order is the order of the paths components
+            components = _split(os.path.relpath(path, folder))
+            if components <= start_after:
+                if components != start_after[:len(components)]:
+                    continue  # Neither this folder nor its content come after start_after
+                skip_files = True  # Some of its sub-folders might come after start_after
+        try:
+            entries = sorted(scandir(path), key=lambda e: e.name)
+        except OSError:
+            logging.warning("Cannot list the content of %s" % path)
+            continue
+
+        files = []
+        folders = []
+        for entry in entries:
+            if not include_hidden and entry.name.startswith('.'):
+                continue
+            if exclude and _matches(entry.name, exclude):
+                continue
+            if shard and 'folder' == shard_by and 0 == depth and not _in_shard(entry.name, shard):
+                continue
+            try:
+                if entry.is_dir():
+                    if max_depth is None or depth < max_depth:
+                        folders.append((entry.path, depth + 1))
+                elif entry.is_file() and (not include or _matches(entry.name, include)):
+                    if shard and 'file' == shard_by and not _in_shard(os.path.relpath(entry.path, folder), shard):
+                        continue
+                    files.append(entry)
+            except OSError:
+                logging.warning("Cannot access %s" % entry.path)
+
+        if files and not skip_files:
+            yield path, files
+        stack.extend(reversed(folders))
+
+
+def covers(folder, file_path, include=None, exclude=None, max_depth=None, include_hidden=False, shard=None,
+           shard_by='folder'):
+    """Check if a file would be listed by walk with the same arguments. The file does not need to exist.
+
+    Arguments:
+    :param folder: Root folder path.
+    :param file_path: File path.
+    See walk for the other parameters.
+    :return: True if the file is in the walked tree.
+    """
+    relative_path = os.path.relpath(file_path, folder)
+    components = _split(relative_path)
+    if not components or os.pardir == components[0]:
+        return False
+    if max_depth is not None and len(components) - 1 > max_depth:
+        return False
+    for name in components:
+        if (not include_hidden and name.startswith('.')) or (exclude and _matches(name, exclude)):
+            return False
+    if include and not _matches(components[-1], include):
+        return False
+    if shard:
+        return _in_shard(components[0] if 'folder' == shard_by else relative_path, shard)
+    return True
+
+
+#######################################################################################################################
+# PRIVATE FUNCTIONS
+#######################################################################################################################
+
+def _matches(name, patterns):
+    return any(fnmatch.fnmatch(name, pattern) for pattern in patterns)
+
+
+def _split(path):
+    path = os.path.normpath(path)
+    return () if os.curdir == path else tuple(path.split(os.sep))
+
+
+def _in_shard(key, shard):
+    # The built-in hash is randomized for each process, CRC32 is not
+    index, count = shard
+    return index == zlib.crc32(key.encode('utf-8', 'surrogateescape')) % count
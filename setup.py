@@ -25,7 +25,11 @@ setup(
         'sqlalchemy==1.2.5',
         'python-magic>=0.4.12',
         'nibabel>=2.1.0',
-        'psycopg2-binary==2.7.4'],
+        'numpy>=1.13.0',
+        'psycopg2-binary==2.7.4',
+        'scandir>=1.5; python_version < "3.5"'],
+    extras_require={
+        'xxhash': ['xxhash>=1.0.0']},
     classifiers=(
         'Intended Audience :: Developers',
         'Intended Audience :: Science/Research',